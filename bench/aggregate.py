@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+# Times and sizes aggregating a large route x month x airline grid of fares:
+# the old dict of per-fare namedtuples (rescanned for the group count, labels
+# and each day's cheapest price) against fares.fare_table.
+
+import collections, datetime as dt, random, sys, time
+from flightscraper import fares
+
+resinfo = collections.namedtuple('resinfo', 'prc group label')
+
+def grid(routes=60, months=6, airlines=8):
+  rng = random.Random(0)
+  start = dt.date(2013, 1, 1)
+  days = [start + dt.timedelta(days=n) for n in xrange(months * 30)]
+  return [('%s %s' % (a, r), ('%s route %s' % (a, r),
+           [(rng.randint(90, 900), d) for d in days]))
+          for r in xrange(routes) for a in xrange(airlines)]
+
+def old(raw_res):
+  date2res = {}
+  for group, (label, res) in raw_res:
+    for prc, dat in res:
+      date2res.setdefault(dat, []).append(resinfo(prc, group, label))
+  ngroups = len(set(r.group for res in date2res.values() for r in res))
+  labels = sorted(set(r.label for res in date2res.itervalues() for r in res))
+  best = dict((d, min(r.prc for r in res)) for d, res in date2res.iteritems())
+  return date2res, ngroups, labels, best
+
+def new(raw_res):
+  table = fares.fare_table(raw_res)
+  return table, table.ngroups(), sorted(table.labels), dict(table.best_on)
+
+def size(x, seen=None):
+  """Rough deep size of x, in bytes."""
+  seen = set() if seen is None else seen
+  if id(x) in seen: return 0
+  seen.add(id(x))
+  n = sys.getsizeof(x)
+  if isinstance(x, dict): n += sum(size(k, seen) + size(v, seen) for k, v in x.iteritems())
+  elif isinstance(x, (list, tuple, set)): n += sum(size(v, seen) for v in x)
+  elif hasattr(x, '__dict__'): n += size(vars(x), seen)
+  return n
+
+if __name__ == '__main__':
+  raw_res = grid()
+  print '%s fares' % sum(len(res) for group, (label, res) in raw_res)
+  for name, f in ('dict of namedtuples', old), ('fare_table', new):
+    start = time.time()
+    agg = f(raw_res)
+    secs = time.time() - start
+    print '%-20s %6.0fms %7.1fMB' % (name, secs * 1000, size(agg[0]) / 1e6)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# End-to-end benchmark of script() against the local fake airline sites (see
+# flightscraper.fakesites), with no network: queries/sec, per-query latency
+# percentiles (from each run's profile.json) and peak memory.  Defaults to the
+# http engine with one worker, i.e. the plain serial flow; -e browser drives
+# Chrome instead, which needs Xvfb, Chrome and chromedriver.
+
+import argparse, contextlib, datetime as dt, json, os, resource, shutil, sys, \
+    tempfile, time, path
+import flightscraper as fs
+from flightscraper import fakesites, planner
+
+def percentile(xs, p):
+  """Nearest-rank percentile of the sorted list xs."""
+  if not xs: return float('nan')
+  return xs[min(len(xs) - 1, max(0, int(round(p / 100. * len(xs))) - 1))]
+
+def searches(profile):
+  """(seconds, counts) of each search span in a profile.json tree."""
+  if 'airline' in profile:
+    counts = dict(profile.get('counts', {}))
+    for child in profile.get('children', []):
+      for k, v in child.get('counts', {}).iteritems(): counts[k] = counts.get(k, 0) + v
+    yield profile['secs'], counts
+  for child in profile.get('children', []):
+    for s in searches(child): yield s
+
+@contextlib.contextmanager
+def sessions(cfg, srv):
+  if cfg.engine == 'http':
+    cfg.proxy = '127.0.0.1:%s' % srv.server_port
+    with fs.http_sessions(cfg) as ss: yield ss
+  else:
+    from flightscraper import chrome
+    fs.urls.update(srv.site_urls())
+    cfg.page_profile = chrome.lean_profile() if cfg.lean else None
+    with contextlib.nested(*[chrome.browser(display, cfg.debug, cfg.page_profile,
+                                            cfg.tabs == 1)
+                             for display in chrome.free_displays(cfg.workers)]) as wds:
+      yield wds
+
+def main(argv=sys.argv):
+  p = argparse.ArgumentParser(description='Benchmark scraping against local fake sites.')
+  p.add_argument('-e', '--engine', choices=['http', 'browser'], default='http')
+  p.add_argument('-j', '--workers', type=int, default=1)
+  p.add_argument('-t', '--tabs', type=int, default=1,
+      help='Tabs per browser (browser engine only).')
+  p.add_argument('-n', '--runs', type=int, default=3)
+  p.add_argument('--spec', type=argparse.FileType('r'),
+      help='Query spec; defaults to the built-in search, 30 days out.')
+  p.add_argument('--latency', type=float, default=50,
+      help='Mean fake-site latency per request, in ms. (default: %(default)s)')
+  p.add_argument('--jitter', type=float, default=10,
+      help='Its standard deviation, in ms. (default: %(default)s)')
+  p.add_argument('--fail-rate', type=float, default=0,
+      help='Fraction of results pages that fail with a 503.')
+  p.add_argument('--seed', type=int, default=0)
+  p.add_argument('--lean', action='store_true',
+      help='Lean page loads (browser engine only).')
+  p.add_argument('--json', action='store_true', help='Print the summary as JSON.')
+  cfg = p.parse_args(argv[1:])
+
+  if cfg.spec: routes = planner.load_spec(cfg.spec)
+  else:
+    [r] = planner.default_spec()
+    day = dt.date.today() + dt.timedelta(days=30)
+    routes = [r._replace(dates=planner.expand_dates([day.isoformat()], 3))]
+  srv = fakesites.server(0, cfg.latency / 1000., cfg.jitter / 1000., cfg.fail_rate,
+                         cfg.seed).start()
+  tmp = path.path(tempfile.mkdtemp(prefix='flightscraper-bench-'))
+  run_cfg = argparse.Namespace(
+      test=False, debug=False, urlbase=path.path('http://localhost'),
+      engine=cfg.engine, workers=cfg.workers, routes=routes, cache=None,
+      store=None, screenshots='none', prometheus=None, record=None,
+      replay=None, proxy=None, health=None, tries=3, deadline=None,
+      resume=None, lean=cfg.lean, page_profile=None, tabs=cfg.tabs,
+      cluster=None, site=None)
+
+  walls, lats, counts = [], [], {}
+  stdout = sys.stdout
+  try:
+    with sessions(run_cfg, srv) as wds:
+      for i in xrange(cfg.runs):
+        run_cfg.outdir = tmp / str(i)
+        run_cfg.outdir.mkdir_p()
+        run_cfg.now = dt.datetime.now()
+        # Retried failures print their tracebacks; keep them out of the summary.
+        sys.stdout = open(os.devnull, 'w')
+        try:
+          start = time.time()
+          fs.script(wds, run_cfg)
+          walls.append(time.time() - start)
+        finally: sys.stdout = stdout
+        with open(run_cfg.outdir / 'profile.json') as f:
+          for secs, c in searches(json.load(f)):
+            lats.append(secs)
+            for k, v in c.iteritems(): counts[k] = counts.get(k, 0) + v
+  finally:
+    srv.shutdown()
+    shutil.rmtree(tmp, ignore_errors=True)
+
+  lats.sort()
+  summary = dict(
+    engine=cfg.engine, workers=cfg.workers, runs=cfg.runs, queries=len(lats),
+    latency_ms=cfg.latency, fail_rate=cfg.fail_rate,
+    wall_secs=sum(walls), qps=len(lats) / sum(walls),
+    p50_ms=percentile(lats, 50) * 1000, p95_ms=percentile(lats, 95) * 1000,
+    max_ms=lats[-1] * 1000 if lats else float('nan'),
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+    requests=srv.requests, injected_failures=srv.failures,
+    retries=counts.get('retries', 0), errors=counts.get('errors', 0),
+    page_kb=counts.get('page_bytes', 0) / 1024.)
+  if cfg.json:
+    print json.dumps(summary, indent=1, sort_keys=True)
+    return
+  print '%(queries)s queries in %(runs)s runs on %(workers)s %(engine)s worker(s), ' \
+        '%(latency_ms).0fms site latency, %(fail_rate).0f%% failures' % \
+        dict(summary, fail_rate=cfg.fail_rate * 100)
+  print '  %(qps).2f queries/sec, p50 %(p50_ms).0fms, p95 %(p95_ms).0fms, ' \
+        'max %(max_ms).0fms' % summary
+  print '  %(requests)s requests, %(injected_failures)s failed, %(retries)s ' \
+        'retries, %(errors)s errors' % summary
+  if summary['page_kb']: print '  %(page_kb).0fKB of pages' % summary
+  print '  peak RSS %(peak_rss_mb).1fMB' % summary
+
+if __name__ == '__main__': main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+# Cold-start cost of the package: each case runs in a fresh interpreter, and
+# the best of several runs is reported along with which heavy dependencies
+# got loaded.  Pass another checkout's directory to compare against it (e.g.
+# one made with git worktree before the lazy-import split).
+
+import subprocess, sys, time
+
+heavy = ['selenium', 'ludibrio', 'ipdb', 'pyjade', 'jinja2', 'parsedatetime',
+         'dateutil', 'lxml', 'PIL']
+
+cases = [
+  ('import', 'import flightscraper'),
+  ('--help', 'import flightscraper\ntry: flightscraper.main(["flightscraper", "--help"])\n'
+             'except SystemExit: pass'),
+  ('toprc/parse_date', 'import flightscraper as fs\n'
+                       'fs.toprc("$123"); fs.parse_date("Fri Dec 21")'),
+]
+
+report = '''
+import sys
+print >> sys.stderr, ' '.join(m for m in %r if m in sys.modules)
+'''
+
+def run(tree, code, n=5):
+  best = None
+  for _ in xrange(n):
+    start = time.time()
+    p = subprocess.Popen([sys.executable, '-c', code + report % heavy],
+                         cwd=tree, stdout=open('/dev/null', 'w'),
+                         stderr=subprocess.PIPE)
+    loaded = p.communicate()[1].strip().splitlines()[-1:]
+    secs = time.time() - start
+    best = secs if best is None else min(best, secs)
+  return best, loaded[0] if loaded else ''
+
+if __name__ == '__main__':
+  trees = sys.argv[1:] or ['.']
+  baseline = run('.', 'pass')[0]
+  print 'bare interpreter: %.0fms' % (baseline * 1000)
+  for name, code in cases:
+    for tree in trees:
+      secs, loaded = run(tree, code)
+      print '%-18s %-24s %6.0fms  loads: %s' % (name, tree, secs * 1000,
+                                                loaded or '-')
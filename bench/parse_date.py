@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+# Times parse_date against the old parsedatetime-based parser on the shapes
+# the airline sites emit, as a grid of results would hit it.
+
+import datetime as dt, timeit
+import flightscraper as fs
+
+ref = dt.date(2012, 12, 21)
+days = [ref + dt.timedelta(days=n) for n in xrange(-15, 16)]
+texts = ([d.strftime('%a %b %d') for d in days] +
+         [d.strftime('%B %Y %d') for d in days] +
+         [d.strftime('%m/%d/%Y') for d in days])
+
+def slow():
+  for t in texts: fs.parse_date_slow(t)
+def fast():
+  for t in texts: fs.parse_date(t, ref)
+def cold():
+  fs.date_memo.clear()
+  fast()
+
+if __name__ == '__main__':
+  mismatches = [t for t in texts if fs.parse_date(t, ref) != fs.parse_date_slow(t)]
+  n = 20
+  for name, f in ('parsedatetime', slow), ('parse_date (cold)', cold), ('parse_date (memo)', fast):
+    secs = min(timeit.repeat(f, number=n, repeat=3))
+    print '%-20s %8.1f us/date' % (name, secs / n / len(texts) * 1e6)
+  print '%s of %s dates differ from parsedatetime (it assumes the current year)' % (
+      len(mismatches), len(texts))
+  print 'parsed %(parsed)s, fell back %(fallback)s' % fs.date_stats
@@ -3,38 +3,22 @@
 """
 Drives a browser to search for tickets across multiple airline sites,
 scraping/emailing/plotting fare information.
+
+Only the standard library and path.py load with this module.  selenium (see
+flightscraper.chrome), the report templates (flightscraper.report), the http
+engine, parsedatetime and ipdb are each imported when first needed.
 """
 
-from selenium import webdriver
-from selenium.webdriver.remote.webelement import WebElement
-from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import NoSuchElementException
-import cPickle as pickle, cStringIO as StringIO, argparse, contextlib, \
-    datetime as dt, functools, getpass, logging, ludibrio, os, re, smtplib, \
-    socket, subprocess, sys, time, pprint, calendar, collections, urllib, \
-    itertools as itr, traceback
+import cPickle as pickle, argparse, contextlib, datetime as dt, functools, \
+    getpass, logging, os, re, socket, sys, time, calendar, \
+    collections, urllib, traceback, threading, Queue
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import dateutil.relativedelta as rd, ipdb, pyjade, pyjade.ext.html, path
-from parsedatetime import parsedatetime as pdt, parsedatetime_consts as pdc
-
-class html_compiler(pyjade.ext.html.HTMLCompiler):
-  def visitCode(self, code):
-    if not code.buffer and not code.block:
-      exec code.val.lstrip() in self.global_context, self.local_context
-    pyjade.ext.html.HTMLCompiler.visitCode(self, code)
-
-def jade2html(tmpl, globals, locals):
-  compiler = html_compiler(pyjade.Parser(tmpl).parse())
-  env = dict(globals)
-  env.update(locals)
-  with pyjade.ext.html.local_context_manager(compiler, env):
-    return compiler.compile()
-
-date_parser = pdt.Calendar(pdc.Constants())
-now = dt.datetime.now()
-
-def month_of(date): return date + rd.relativedelta(day=1)
+import path
+from . import adapters, alerts, cache, health, journal, planner, screenshots, \
+    store, timing
+
+def month_of(date): return date.replace(day=1)
 def fmt_time(time): return time.strftime('%a %Y-%m-%d %I:%M %p')
 def fmt_date(date, short=False):
   return date.strftime('%m/%d/%Y') if not short else \
@@ -42,124 +26,153 @@ def fmt_date(date, short=False):
 day_names = set.union(set([
   x.lower() for xs in calendar.day_name,calendar.day_abbr for x in xs]))
 space = re.compile(r'\s+')
-def parse_date(text):
+date_parser = None
+def parse_date_slow(text):
+  global date_parser
+  if date_parser is None:
+    from parsedatetime import parsedatetime as pdt, parsedatetime_consts as pdc
+    date_parser = pdt.Calendar(pdc.Constants())
   text = text.strip()
   if space.split(text, 1)[0].lower() in day_names:
     text = space.split(text, 1)[1]
   return dt.date(*date_parser.parse(text)[0][:3])
 
+# The shapes the airline sites actually emit, e.g. "Fri Dec 21", "Dec 21,
+# 2012", "December 2012 21" and "12/21/2012".  Anything else falls back to
+# parsedatetime.
+month_nums = dict((m.lower(), i) for i, m in enumerate(calendar.month_abbr) if m)
+date_shapes = [
+  (re.compile(r'^(?:(?:%s),?\s)?([a-z]{3})[a-z]*\.?\s(\d{1,2})(?:,?\s(\d{4}))?$'
+              % '|'.join(day_names)),
+   lambda m: (m.group(3), m.group(1), m.group(2))),
+  (re.compile(r'^([a-z]{3})[a-z]*\.?\s(\d{4})\s(\d{1,2})$'),
+   lambda m: (m.group(2), m.group(1), m.group(3))),
+  (re.compile(r'^(\d{1,2})/(\d{1,2})(?:/(\d{4}|\d{2}))?$'),
+   lambda m: (m.group(3), m.group(1), m.group(2))),
+  (re.compile(r'^(\d{4})-(\d{2})-(\d{2})$'),
+   lambda m: m.groups()),
+]
+date_memo = {}
+date_memo_size = 4096
+# Parses that missed the memo, and how many of those needed parsedatetime.
+date_stats = collections.Counter()
+
+def infer_year(month, day, ref):
+  """
+  The year putting month/day closest to ref, for dates shown without one
+  (so January results seen in a December search land in the next year).
+  """
+  return min((ref.year + d for d in (-1, 0, 1)),
+             key=lambda y: abs((dt.date(y, month, min(day, 28)) - ref).days))
+
+def parse_shape(text, ref):
+  """
+  The date in text (lowercased, single-spaced) if it has one of the known
+  shapes, else None.
+  """
+  for shape, fields in date_shapes:
+    m = shape.match(text)
+    if m: break
+  else: return None
+  year, month, day = fields(m)
+  month = int(month) if month.isdigit() else month_nums.get(month)
+  if month is None: return None
+  day = int(day)
+  if year is None: year = infer_year(month, day, ref)
+  elif len(year) == 2: year = 2000 + int(year)
+  try: return dt.date(int(year), month, day)
+  except ValueError: return None
+
+def parse_date(text, ref=None):
+  """
+  Parses a date as shown on the airline sites.  ref is the date searched for
+  (default: today), from which missing years are inferred.
+  """
+  ref = ref or dt.date.today()
+  key = text, ref
+  try: return date_memo[key]
+  except KeyError: pass
+  date_stats['parsed'] += 1
+  res = parse_shape(space.sub(' ', text.strip().lower()), ref)
+  if res is None:
+    date_stats['fallback'] += 1
+    logging.debug('parse_date fell back to parsedatetime for %r', text)
+    res = parse_date_slow(text)
+  if len(date_memo) >= date_memo_size: date_memo.clear()
+  date_memo[key] = res
+  return res
+
+# Per thread: the chrome.tab the thread is driving, if any.
+local = threading.local()
+
+def sleep(secs):
+  """
+  Sleeps, handing the browser to the other tabs sharing it (see chrome.tab)
+  meanwhile if this thread is driving one.
+  """
+  tab = getattr(local, 'tab', None)
+  if tab is None: time.sleep(secs)
+  else: tab.idle(secs)
+
 def retry(f, trials=10):
-  for trial in xrange(trials):
+  for trial, delay in zip(xrange(trials), backoff(first=.1)):
     try: return f()
     except:
-      if trial < trials - 1: time.sleep(1)
+      if trial < trials - 1: sleep(delay)
       else: raise
 
-def retry_if_nexist(multireturn=False):
-  def dec(f):
-    @functools.wraps(f)
-    def wrapper(self, x, retry = True, maxsec = 60, dummy = True, permit_none = False):
-      start = time.time()
-      while 1:
-        try:
-          res = f(self, x)
-          if multireturn and not permit_none and res == []:
-            raise NoSuchElementException()
-          return res
-        except NoSuchElementException:
-          if not retry: return ludibrio.Dummy() if dummy else None
-          if time.time() - start > maxsec: raise timeout_exception()
-          time.sleep(1)
-    return wrapper
-  return dec
+def backoff(first=.05, cap=1):
+  """
+  Yields sleep intervals doubling from first up to cap, so that short waits
+  end almost as soon as their condition holds while long ones still poll
+  gently.
+  """
+  delay = first
+  while 1:
+    yield delay
+    delay = min(2 * delay, cap)
+
+def wait_until(pred, maxsec=None, cap=1):
+  """
+  Polls pred with backoff until it returns true (then returns True) or maxsec
+  passes (then returns False).
+  """
+  start = time.time()
+  for delay in backoff(cap=cap):
+    if pred(): return True
+    if maxsec is not None and time.time() - start > maxsec: return False
+    sleep(delay)
 
 class timeout_exception(Exception): pass
 
+def post_mortem():
+  """Debugs the exception being handled, in ipdb if it's installed."""
+  try: import ipdb as debugger
+  except ImportError: import pdb as debugger
+  debugger.post_mortem(sys.exc_info()[2])
+
 def retry_if_timeout(f):
+  """
+  Retries the airline function under the run's retry policy (see
+  flightscraper.health), which may also skip it altogether.
+  """
   @functools.wraps(f)
   def wrapper(wd, *args, **kw):
-    for trial in xrange(3):
+    def attempt():
       try: return f(wd, *args, **kw)
       except timeout_exception:
-        if trial == 2: raise
-        time.sleep(1)
-      except Exception as ex:
-        if wd.debug: ipdb.post_mortem(sys.exc_info()[2])
-        if trial < 2: print traceback.format_exc()
-        else: raise
+        timing.count('timeouts')
+        raise
+      except Exception:
+        if wd.debug: post_mortem()
+        raise
+    return health.current.call(f.__name__, attempt)
   return wrapper
 
-class rich_driver(object):
-  def __init__(self, wd, debug):
-    self.wd = wd
-    self.debug = debug
-  def __getattr__(self, attr): return getattr(self.wd, attr)
-  def ckpt(self):
-    """Callback from an airline function after filling but before submitting
-    the form.  Useful if you want to take a screenshot, make some edits,
-    etc."""
-    pass
-  @retry_if_nexist()
-  def xpath(self, x): return rich_web_elt(self.wd.find_element_by_xpath(x))
-  @retry_if_nexist(True)
-  def xpaths(self, x): return map(rich_web_elt, self.wd.find_elements_by_xpath(x))
-  @retry_if_nexist()
-  def getid(self, x): return rich_web_elt(self.wd.find_element_by_id(x))
-  @retry_if_nexist()
-  def name(self, x): return rich_web_elt(self.xpath('//*[@name=%r]' % (x,)))
-  @retry_if_nexist()
-  def css(self, x): return rich_web_elt(self.wd.find_element_by_css_selector(x))
-  @retry_if_nexist(True)
-  def csss(self, x): return map(rich_web_elt, self.wd.find_elements_by_css_selector(x))
-
 price_re = re.compile(r'\d+')
 def toprc(x):
-  return int(price_re.search(x.text
-                        if type(x) is rich_web_elt or type(x) is WebElement
-                        else x).group())
-
-class rich_web_elt(object):
-  def __init__(self, elt):
-    self.elt = elt
-  def clear(self):
-    self.elt.clear()
-    return self
-  def click(self):
-    self.elt.click()
-    return self
-  def send_keys(self, keys):
-    self.elt.send_keys(keys)
-    return self
-  def delay(self, delay = 1):
-    time.sleep(delay)
-    return self
-  def tab(self):
-    self.elt.send_keys(Keys.TAB)
-    return self
-  def enter(self):
-    self.elt.send_keys(Keys.ENTER)
-    return self
-  def option(self, val):
-    self.elt.find_element_by_xpath('option[@value=%r]' % str(val)).click()
-    return self
-  def set(self, value):
-    if self.elt.is_selected() != value:
-      self.elt.click()
-    return self
-  def slow_keys(self, keys):
-    for k in keys:
-      self.send_keys(k)
-      time.sleep(.1)
-    return self
-  def wait_displayed(self, sleep=1, max=20):
-    start = time.time()
-    while time.time() - start < max and not self.elt.is_displayed():
-      time.sleep(sleep)
-    if not self.elt.is_displayed():
-      raise Exception('exceeded timeout waiting for element to be displayed')
-    return self
-  def __getattr__(self, attr):
-    return getattr(self.elt, attr)
+  """The price in x, a string or an element showing one."""
+  return int(price_re.search(x if isinstance(x, basestring) else x.text).group())
 
 def fullcity(tla):
   return dict(ewr = 'Newark',
@@ -168,12 +181,22 @@ def fullcity(tla):
       oak = 'Oakland',
       sjc = 'San Jose')[tla.lower()]
 
+# Search pages, per airline.
+urls = dict(
+  united='http://united.com',
+  aa='http://www.aa.com/reservation/oneWaySearchAccess.do',
+  virginamerica='http://virginamerica.com',
+  bing='http://bing.com/travel',
+  southwest='http://www.southwest.com/cgi-bin/lowFareFinderEntry',
+  delta='http://www.delta.com/booking/searchFlights.do',
+)
+
 @retry_if_timeout
 def united(wd, org, dst, date, nearby=False):
   """
   Returns list of (best price, day) pairs for month around date.
   """
-  wd.get('http://united.com')
+  wd.get(urls['united'])
   wd.getid('ctl00_ContentInfo_Booking1_rdoSearchType2').click()
   wd.getid('ctl00_ContentInfo_Booking1_Origin_txtOrigin').clear().send_keys(org)
   wd.getid('ctl00_ContentInfo_Booking1_Destination_txtDestination').clear().send_keys(dst)
@@ -185,9 +208,9 @@ def united(wd, org, dst, date, nearby=False):
   wd.ckpt()
   wd.getid('ctl00_ContentInfo_Booking1_btnSearchFlight').click()
   def gen():
-    for x in wd.find_elements_by_css_selector('.on'):
-      date, _, prc = x.text.split('\n')
-      yield toprc(prc), parse_date(date)
+    for text, in wd.extract('.on', permit_none=True):
+      day, _, prc = text.split('\n')
+      yield toprc(prc), parse_date(day, date)
   return list(gen())
 
 @retry_if_timeout
@@ -200,7 +223,7 @@ def aa(wd, org, dst, date, dist_org=0, dist_dst=0):
   for dist in dist_org, dist_dst:
     if dist not in [None, 0, 30, 60, 90]:
       raise Exception('dist_org/dist_dst must be in [0,30,60,90]')
-  wd.get('http://www.aa.com/reservation/oneWaySearchAccess.do')
+  wd.get(urls['aa'])
   wd.getid('flightSearchForm.originAirport').clear().send_keys(org)
   wd.getid('flightSearchForm.destinationAirport').clear().send_keys(dst)
   wd.getid('flightSearchForm.originAlternateAirportDistance').option(dist_org)
@@ -213,9 +236,9 @@ def aa(wd, org, dst, date, dist_org=0, dist_dst=0):
   wd.ckpt()
   wd.getid('flightSearchForm').submit()
   def gen():
-    for x in wd.csss('.tabNotActive, .highlightSubHeader'):
-      date, prc = x.text.split('from')
-      yield toprc(prc), parse_date(date)
+    for text, in wd.extract('.tabNotActive, .highlightSubHeader'):
+      day, prc = text.split('from')
+      yield toprc(prc), parse_date(day, date)
   return list(gen())
 
 @retry_if_timeout
@@ -225,23 +248,22 @@ def virginamerica(wd, org, dst, date):
 
   Returns list of (best price, day) pairs for +/- 3 days around date.
   """
-  wd.get('http://virginamerica.com')
+  wd.get(urls['virginamerica'])
   wd.getid('owRadio').click()
   wd.xpath('//select[@name="flightSearch.origin"]/option[@value=%r]' % org.upper()).click()
   wd.xpath('//select[@name="flightSearch.destination"]/option[@value=%r]' % dst.upper()).click()
   wd.name('flightSearch.depDate.MMDDYYYY').clear().send_keys(fmt_date(date)).tab().delay()
   wd.ckpt()
   wd.getid('SearchFlightBt').click()
-  return [(toprc(prc), parse_date(day.text))
-      for prc, day in zip(wd.xpaths('//*[@class="fsCarouselCost"]'),
-                          wd.xpaths('//*[@class="fsCarouselDate"]'))]
+  prcs, days = wd.extract(('[class="fsCarouselCost"]', '[class="fsCarouselDate"]'))
+  return [(toprc(prc), parse_date(day, date)) for (prc,), (day,) in zip(prcs, days)]
 
 @retry_if_timeout
 def bing(wd, org, dst, date, near_org=False, near_dst=False):
   """
   Returns [(best price, date)].
   """
-  wd.get('http://bing.com/travel')
+  wd.get(urls['bing'])
   wd.getid('oneWayLabel').click()
   wd.getid('orig1Text').click().clear().send_keys(org).tab()
   wd.getid('dest1Text').click().clear().send_keys(dst).tab()
@@ -250,9 +272,10 @@ def bing(wd, org, dst, date, near_org=False, near_dst=False):
   wd.getid('leave1').clear().send_keys(fmt_date(date))
   wd.getid('PRI-HP').set(False)
   wd.ckpt()
-  wd.find_element_by_css_selector('.sbmtBtn').click()
+  wd.css('.sbmtBtn').click()
   # Wait for "still searching" to disappear.
-  while wd.getid('searching').is_displayed(): time.sleep(1)
+  searching = wd.getid('searching')
+  wait_until(lambda: not searching.is_displayed())
   return [(toprc(wd.xpath('//span[@class="price"]')), date)]
 
 @retry_if_timeout
@@ -260,18 +283,20 @@ def southwest(wd, org, dst, date):
   """
   Returns list of (best price, date) pairs for month around date.
   """
-  wd.get('http://www.southwest.com/cgi-bin/lowFareFinderEntry')
+  wd.get(urls['southwest'])
   wd.getid('oneWay').click()
   wd.getid('originAirport_displayed').clear().send_keys(org).tab()
   wd.getid('destinationAirport_displayed').clear().send_keys(dst).tab()
   wd.getid('outboundDate').option(fmt_date(month_of(date)))
   wd.ckpt()
   wd.getid('submitButton').click()
-  month = wd.css('.carouselTodaySodaIneligible .carouselBody').text
+  months, days = wd.extract(
+      ('.carouselTodaySodaIneligible .carouselBody', '.fareAvailableDay'))
+  [month] = months[0]
   def gen():
-    for x in wd.csss('.fareAvailableDay'):
-      day, prc = x.text.split('\n')
-      yield toprc(prc), parse_date('%s %s' % (month, day))
+    for text, in days:
+      day, prc = text.split('\n')
+      yield toprc(prc), parse_date('%s %s' % (month, day), date)
   return list(gen())
 
 @retry_if_timeout
@@ -279,7 +304,7 @@ def delta(wd, org, dst, date, nearby=False):
   """
   Returns [(best price, date)].
   """
-  wd.get('http://www.delta.com/booking/searchFlights.do')
+  wd.get(urls['delta'])
   wd.getid('oneway_link').click()
   wd.getid('departureCity_0').clear().send_keys(org)
   wd.getid('destinationCity_0').clear().send_keys(dst)
@@ -297,191 +322,255 @@ def farecmp():
 def jetblue():
   pass
 
-@contextlib.contextmanager
-def quitting(x):
-  try: yield x
-  finally: x.quit()
+airlines = dict((f.__name__, f) for f in
+    [united, aa, virginamerica, bing, southwest, delta, farecmp, jetblue])
+
+# A single search: airline names an adapter (see flightscraper.adapters) whose
+# search function is called with a driver followed by args and kw.  group is
+# what the reports aggregate by (a date is fully covered once every group has
+# a price for it).  routes are the (org, dst) of the spec routes the search is
+# for; its args may use an alternate origin.
+query = collections.namedtuple('query', 'group label airline args kw routes')
+
+def run_pool(wds, tasks):
+  """
+  Runs each task (a function of a driver) on whichever of the drivers wds is
+  free next, one thread per driver.  Returns the results in task order.  Once
+  a task raises, no new tasks are started, and the first exception is
+  re-raised after the in-flight ones finish.
+  """
+  pending = Queue.Queue()
+  for i, task in enumerate(tasks): pending.put((i, task))
+  results = [None] * len(tasks)
+  errors = []
+  def work(wd):
+    while not errors:
+      try: i, task = pending.get_nowait()
+      except Queue.Empty: return
+      try: results[i] = task(wd)
+      except: errors.append(sys.exc_info())
+  threads = [threading.Thread(target=work, args=(wd,)) for wd in wds]
+  for t in threads: t.daemon = True; t.start()
+  for t in threads: t.join()
+  if errors: raise errors[0][0], errors[0][1], errors[0][2]
+  return results
 
 @contextlib.contextmanager
-def subproc(*args, **kwargs):
-  p = subprocess.Popen(*args, **kwargs)
-  try: yield p
-  finally: p.terminate(); p.wait()
-
-def script(wd, cfg):
-  org, dst, date = 'sfo', 'phl', dt.date(2012,12,21)
-  cal = calendar.Calendar(6)
-
-  html_path = 'results.html'
-  report_url = cfg.urlbase / urllib.quote(cfg.outdir) / html_path
-  def pre_path(label): return '%s presubmit.png' % (label)
-  def post_path(label): return '%s postsubmit.png' % (label)
-  def wrap(label, func):
-    class very_rich_driver(rich_driver):
+def http_sessions(cfg):
+  """
+  One httpengine session per worker, recording to or replaying from
+  cfg.record/cfg.replay if given.
+  """
+  from . import httpengine
+  mode = 'record' if cfg.record else 'replay' if cfg.replay else 'live'
+  ss = [httpengine.session(mode, cfg.record or cfg.replay, cfg.proxy)
+        for _ in xrange(cfg.workers)]
+  try: yield ss
+  finally:
+    for s in ss: s.close()
+
+html_path = 'results.html'
+def pre_path(label): return '%s presubmit.png' % (label)
+def post_path(label): return '%s postsubmit.png' % (label)
+
+class searcher(object):
+  """
+  Runs searches, for a run (see script) or a cluster worker's shard.  Each
+  search gets a timing span; its screenshots go to shots and its element
+  waits to waits, as (label, method, selector, seconds).  Results go to jnl
+  (if any) and cfg.cache as they come in.  A search that fails or is
+  skipped gets empty results and a (query, why) in missing, and the rest go
+  on without it.
+  """
+  def __init__(self, cfg, shots, jnl=None):
+    self.cfg, self.shots, self.jnl = cfg, shots, jnl
+    self.waits, self.missing = [], []
+  def drive(self, wd, q):
+    cfg = self.cfg
+    # Screenshots are taken as raw bytes and only handed to the writer once
+    # we know whether cfg.screenshots wants them.
+    pngs = {}
+    def snap(name):
+      if cfg.screenshots != 'none':
+        pngs[name] = wd.get_screenshot_as_base64().decode('base64')
+    from . import chrome
+    class very_rich_driver(chrome.rich_driver):
       def ckpt(self):
-        self.wd.save_screenshot(cfg.outdir / pre_path(label))
-    try: return label, func(very_rich_driver(wd, cfg.debug))
-    finally: wd.save_screenshot(cfg.outdir / post_path(label))
+        timing.phase('screenshot')
+        snap(pre_path(q.label))
+        chrome.rich_driver.ckpt(self)
+    rwd = very_rich_driver(wd, cfg.debug)
+    if cfg.page_profile: cfg.page_profile.apply(wd, q.airline)
+    ok = False
+    try:
+      res = adapters.get(q.airline).search('browser')(rwd, *q.args, **q.kw)
+      ok = True
+      rwd.count_bytes()
+      search = timing.current()
+      if search.counts['page_bytes']:
+        health.current.record_pages(q.airline, 'lean' if cfg.page_profile else 'full',
+            search.counts['page_bytes'], search.phases().get('navigate', 0))
+      return res
+    finally:
+      if cfg.screenshots == 'all' or not ok:
+        timing.phase('screenshot')
+        snap(post_path(q.label))
+        for name, png in pngs.iteritems(): self.shots.put(name, png)
+      self.waits.extend((q.label,) + w for w in rwd.waits)
+  def succeeded(self, q, res):
+    if self.jnl: self.jnl.done(q, res)
+    if self.cfg.cache and res: self.cfg.cache.put(q.airline, q.args, q.kw, res)
+  def failed(self, q, why, tb):
+    self.missing.append((q, why))
+    if self.jnl: self.jnl.failed(q, tb)
+  def task(self, q, parent):
+    cfg = self.cfg
+    def task(wd):
+      try:
+        health.current.check(q.airline)
+        pages = dict(pages='lean') if cfg.page_profile else {}
+        with timing.timed(q.label, parent, airline=q.airline, **pages):
+          a = adapters.get(q.airline)
+          if cfg.engine == 'http':
+            res = a.search('http')(wd, *q.args, **q.kw)
+          else:
+            from . import chrome
+            with chrome.driving(wd, a.share_session) as bwd: res = self.drive(bwd, q)
+      except Exception as ex:
+        why = 'skipped: %s' % ex if isinstance(ex, health.skipped) else \
+              'failed: %s' % traceback.format_exception_only(type(ex), ex)[-1].strip()
+        self.failed(q, why, traceback.format_exc())
+        return q.group, (q.label, [])
+      self.succeeded(q, res)
+      return q.group, (q.label, res)
+    return task
+  def run(self, wds, queries, parent):
+    """
+    Searches queries on the drivers wds, under a search span of parent (the
+    pool's threads hang their spans off it explicitly), most expensive first
+    (see planner.schedule).  Returns (group, (label, results)) per query, in
+    order.
+    """
+    if self.cfg.engine == 'browser' and self.cfg.tabs > 1:
+      from . import chrome
+      wds = chrome.tabs(wds, self.cfg.tabs)
+    order = planner.schedule(range(len(queries)), health.current,
+                             key=lambda i: queries[i].airline)
+    with timing.timed('search', parent, workers=len(wds)) as search:
+      res = run_pool(wds, [self.task(queries[i], search) for i in order])
+    out = [None] * len(queries)
+    for i, r in zip(order, res): out[i] = r
+    return out
+
+def script(wds, cfg):
+  # The reports cover the first route, around the middle of its dates.
+  first = cfg.routes[0]
+  org, dst, date = first.org, first.dst, first.dates[len(first.dates) // 2]
+
+  run = timing.span('run')
+  shots = screenshots.writer(cfg.outdir)
+  srch = searcher(cfg, shots)
+  # airline -> (bytes, navigate seconds) of its full page loads, to show what
+  # lean ones save.
+  baselines = {}
 
-  def gen():
-    yield 'united', wrap('united',
-        lambda wd: united(wd, org, dst, date, nearby=True))
-    yield 'aa', wrap('aa',
-        lambda wd: aa(wd, org, dst, date, dist_org=60, dist_dst=30))
-    yield 'virginamerica', wrap('virginamerica',
-        lambda wd: virginamerica(wd, org, dst, date))
-    for offset in xrange(-3, 4, 1):
-      dat = date + rd.relativedelta(days=offset)
-      yield 'bing', wrap('bing %s' % dat,
-          lambda wd: bing(wd, org, dst, dat, near_org=True, near_dst=True))
-    yield 'southwest sfo to phl', wrap('southwest sfo to phl',
-        lambda wd: southwest(wd, org, dst, date))
-    yield 'southwest sjc to phl', wrap('southwest sjc to phl',
-        lambda wd: southwest(wd, 'sjc', dst, date))
-    yield 'southwest oak to phl', wrap('southwest oak to phl',
-        lambda wd: southwest(wd, 'oak', dst, date))
-    for offset in xrange(-3, 4, 1):
-      dat = date + rd.relativedelta(days=offset)
-      yield 'delta', wrap('delta %s' % dat,
-          lambda wd: delta(wd, org, dst, dat, nearby=True))
-
-  if cfg.test:
-    def gen():
-      yield 'southwest sfo to phl', ('southwest sfo to phl', [(249, date)])
-      yield 'southwest sjc to phl', ('southwest sjc to phl', [(229, date)])
-      yield 'united', ('united', [(229, date+rd.relativedelta(days=0)),
-                                  (229, date+rd.relativedelta(days=1))])
-
-  raw_res = list(gen())
-
-  # combine by date
-  resinfo = collections.namedtuple('resinfo', 'prc group label')
-  date2res = {}
-  for group, (label, res) in raw_res:
-    for prc,dat in res:
-      date2res.setdefault(dat, []).append(resinfo(prc, group, label))
-  ngroups = len(set(r.group for res in date2res.values() for r in res))
-
-  # email text report
-  def gen_vals():
-    for dow in cal.iterweekdays():
-      yield '%6s' % calendar.day_abbr[dow]
-    yield '\n'
-    for day, dow in cal.itermonthdays2(*date.timetuple()[:2]):
-      dat = date + rd.relativedelta(day=day)
-      res = date2res.get(dat, [])
-      val = '$%s' % min(r.prc for r in res) \
-            if day > 0 and len(res) == ngroups else ''
-      yield '%6s%s' % (val, '\n' if dow == 5 else '')
-  def gen_days():
-    for day, dow in cal.itermonthdays2(*date.timetuple()[:2]):
-      yield '%6s%s' % ('' if day == 0 else day, '\n' if dow == 5 else '')
-  vals = ''.join(gen_vals()).split('\n')
-  days = ''.join(gen_days()).split('\n')
-  email_text = '\n'.join(line for lines in zip(vals, days) for line in lines)
-  email_text = '''
-%s
-
-<%s>
-'''.strip() % (email_text, report_url)
-
-  # email html report
-  email_tmpl = '''
-!!! 5
-html(lang='en')
-  body
-    table.table.table-bordered
-      thead
-        tr
-          for dow in cal.iterweekdays()
-            th= calendar.day_abbr[dow]
-      tbody
-        for week in cal.monthdays2calendar(*date.timetuple()[:2])
-          tr
-            for day, dow in week
-              td
-                if day > 0
-                  .day-number= day
-                  - dat = date + rd.relativedelta(day=day)
-                  - res = date2res.get(dat, [])
-                  - best = "$%s" % min(r.prc for r in res) if res else '-'
-                  if len(res) == ngroups
-                    .full.price= best
-                  else
-                    .partial.price -
-    a(href=report_url) See full report
-'''
-  email_html = jade2html(email_tmpl, globals(), locals())
-
-  # full web report
-  labels = sorted(set(r.label for res in date2res.itervalues() for r in res))
-  full_tmpl = '''
-!!! 5
-html(lang='en')
-  head
-    title Flight Scraper Results for #{fmt_time(now)}
-    link(href='//netdna.bootstrapcdn.com/twitter-bootstrap/2.1.1/css/bootstrap-combined.min.css', rel='stylesheet')
-    link(href='../main.css', rel='stylesheet')
-  body
-    h1 Flight Scraper Results for #{fmt_time(now)}
-    table.table.table-bordered
-      thead
-        tr
-          for dow in cal.iterweekdays()
-            th= calendar.day_abbr[dow]
-      tbody
-        for week in cal.monthdays2calendar(*date.timetuple()[:2])
-          tr
-            for day, dow in week
-              td
-                if day > 0
-                  .day-number= day
-                  - dat = date + rd.relativedelta(day=day)
-                  - res = date2res.get(dat, [])
-                  - best = "$%s" % min(r.prc for r in res) if res else '-'
-                  if len(res) == ngroups
-                    .full.price= best
-                  else
-                    .partial.price= best
-    table.table.table-striped.table-hover
-      col
-      col
-      col
-      col(style='text-align: right')
-      thead
-        tr
-          th Date
-          th Search
-          th Price
-      tbody
-        for date, res in sorted(date2res.items())
-          for r in res
-            tr
-              td= date
-              td
-                a(href="#label-#{labels.index(r.label)}")= r.label
-              td $#{r.prc}
-    .screenshots
-      for i, label in enumerate(labels)
-        a(name="label-#{i}")
-        h2= label
-        h3 Pre-submit
-        a(href="#{pre_path(label)}")
-          img.scrthumb(src="#{pre_path(label)}")
-        h3 Post-submit
-        a(href="#{post_path(label)}")
-          img.scrthumb(src="#{post_path(label)}")
-    script(src='//ajax.googleapis.com/ajax/libs/jquery/1.8.2/jquery.min.js')
-    script(src='//netdna.bootstrapcdn.com/twitter-bootstrap/2.1.1/js/bootstrap.min.js')
-    script(src='main.js')
-  '''
-  html = jade2html(full_tmpl, globals(), locals())
-  with open(cfg.outdir / html_path, 'w') as f:
-    f.write(html)
-
-  return email_text, email_html, raw_res
+  try:
+    if cfg.test:
+      raw_res = [
+        ('southwest sfo to phl', ('southwest sfo to phl', [(249, date)])),
+        ('southwest sjc to phl', ('southwest sjc to phl', [(229, date)])),
+        ('united', ('united', [(229, date),
+                               (229, date + dt.timedelta(days=1))])),
+      ]
+      by_route = {(org, dst): raw_res}
+    else:
+      queries = planner.plan(cfg.routes)
+      # When resuming, the searches the journal has results for count as
+      # cached; everything else (missing or failed) runs again.
+      prior = journal.load(cfg.outdir).done if cfg.resume else {}
+      srch.jnl = jnl = journal.journal(cfg.outdir, cfg.routes, cfg.now, cfg.resume)
+      policy = health.policy(cfg.health, cfg.tries, deadline=cfg.deadline)
+      try:
+        with health.installed(policy):
+          with timing.timed('cache', run):
+            cached = [prior[q.label] if q.label in prior else
+                      cfg.cache.get(q.airline, q.args, q.kw) if cfg.cache else None
+                      for q in queries]
+          for q, res in zip(queries, cached):
+            if res is not None and q.label not in prior: jnl.done(q, res)
+          todo = [q for q, res in zip(queries, cached) if res is None]
+          # Coordinating, the searches are run by cluster workers instead.
+          fresh = iter(cfg.cluster.run(todo, srch, run) if cfg.cluster else
+                       srch.run(wds, todo, run))
+      finally:
+        jnl.close()
+      baselines = policy.page_baselines()
+      all_res = [next(fresh) if res is None else (q.group, (q.label, res))
+                 for q, res in zip(queries, cached)]
+      if not any(res for group, (label, res) in all_res):
+        raise Exception('no search succeeded:\n%s' % '\n'.join(
+            '%s: %s' % (q.label, why) for q, why in srch.missing))
+      by_route = {}
+      for q, res in zip(queries, all_res):
+        for route in q.routes: by_route.setdefault(route, []).append(res)
+      raw_res = by_route[org, dst]
+    # Compared with the store's previous run before this one joins it.  Fake
+    # test fares aren't compared with real ones.
+    with timing.timed('changes', run):
+      changes = [] if cfg.test else alerts.changes(cfg.store, cfg.now, by_route)
+    if cfg.store and not cfg.test:
+      # A resumed run may have been recorded already; it's all there now.
+      for (o, d), res in by_route.iteritems():
+        cfg.store.append(cfg.now, o, d, res, replace=bool(cfg.resume))
+  finally:
+    with timing.timed('screenshots', run): shots.close()
+
+  # element waits, slowest first
+  with open(cfg.outdir / 'waits.txt', 'w') as f:
+    for label, method, x, secs in sorted(srch.waits, key=lambda w: -w[-1]):
+      print >> f, '%7.2fs  %-24s %-8s %s' % (secs, label, method, x)
+
+  with timing.timed('report', run):
+    from . import report
+    email_text, email_html = report.render(cfg, raw_res, date, shots.thumbs,
+        timing.search_timings(run, srch.waits, baselines),
+        [(q.group, q.label, why) for q, why in srch.missing if (org, dst) in q.routes])
+    report.render_set(cfg, cfg.routes, by_route, shots.thumbs,
+        [(route, q.group, q.label, why) for q, why in srch.missing
+         for route in q.routes])
+  run.end()
+  timing.write_json(run, cfg.outdir / 'profile.json')
+  if cfg.prometheus: timing.write_prometheus(run, cfg.prometheus)
+  return email_text, email_html, by_route, changes
+
+def save_results(cfg, email_text, email_html, by_route):
+  # Keyed by route, since a search's label doesn't say which route it was for
+  # (see store.load_results).
+  with open(cfg.outdir / 'results.pickle', 'w') as f: pickle.dump(by_route, f, 2)
+
+def mail_results(cfg, email_text, email_html, mailer):
+  mail = MIMEMultipart('alternative')
+  mail['From'] = cfg.mailfrom
+  mail['To'] = cfg.mailto
+  mail['Subject'] = 'Flight Scraper Results for %s' % fmt_time(cfg.now)
+  mail.attach(MIMEText(email_text, 'plain'))
+  mail.attach(MIMEText(email_html, 'html'))
+  mailer.send(mail)
+
+def notify(cfg, email_text, email_html, changes, mailer):
+  """
+  Sends the results to cfg.mailto, if the fares changed since the last run
+  (or cfg.mail_always, or it's a test), and fare alerts to cfg.watch's
+  subscribers.
+  """
+  # Only news goes to stdout, so a cron job's output is mailed only then.
+  if changes: print '%s fare change(s) since the last run' % len(changes)
+  if cfg.mailto and (changes or cfg.mail_always or cfg.test):
+    mail_results(cfg, email_text, email_html, mailer)
+  if cfg.watch and not cfg.test: alerts.deliver(cfg, changes, mailer)
 
 def main(argv = sys.argv):
+  now = dt.datetime.now()
   default_from = '%s@%s' % (getpass.getuser(), socket.getfqdn())
 
   p = argparse.ArgumentParser(description=__doc__)
@@ -498,45 +587,173 @@ def main(argv = sys.argv):
       print results to stdout.''')
   p.add_argument('-F', '--mailfrom', default=default_from,
       help='Email address results are sent from. (default: %s)' % default_from)
+  p.add_argument('--mail-always', action='store_true',
+      help='''Email the results to --mailto even if no fare changed since the
+      last run.''')
+  p.add_argument('--watch', type=argparse.FileType('r'), metavar='FILE',
+      help='''JSON watch rules of subscribers to alert when a fare drops (see
+      flightscraper.alerts).''')
+  p.add_argument('--smtp', default='localhost', metavar='HOST[:PORT]',
+      help='Mail server to send through. (default: %(default)s)')
+  p.add_argument('--spec', type=argparse.FileType('r'),
+      help='''JSON query spec of routes, dates and airlines to search (see
+      flightscraper.planner); defaults to the built-in SFO-PHL search.''')
+  p.add_argument('--site', metavar='DIR',
+      help='''Keep the report set (an index, and pages per route and month)
+      in DIR across runs, re-rendering only the pages whose results changed,
+      rather than in each output directory.''')
+  p.add_argument('--plan', action='store_true',
+      help='Just print the airline calls the spec expands to.')
+  p.add_argument('-j', '--workers', type=int, default=1,
+      help='''Number of browser sessions (each on its own Xvfb display) to
+      spread the searches across. (default: 1)''')
+  p.add_argument('--tabs', type=int, default=1,
+      help='''Number of tabs per browser session to run searches in at once,
+      so their waits for results overlap. (default: 1)''')
+  p.add_argument('--cache-dir', default='~/.flightscraper/cache',
+      help='Where search results are cached. (default: %(default)s)')
+  p.add_argument('--max-age', type=int,
+      help='''Ignore cached results older than this many seconds, even if the
+      airline's TTL would still allow them.''')
+  p.add_argument('--no-cache', action='store_true',
+      help='Always search, neither reading nor writing the result cache.')
+  p.add_argument('-s', '--screenshots', choices=['none', 'failures', 'all'],
+      default='all',
+      help='''Which searches to keep pre/post-submit screenshots of.
+      (default: all)''')
+  p.add_argument('--store', default='~/.flightscraper/fares.sqlite',
+      help='''Fare history database each run's results are appended to (see
+      flightscraper-store). (default: %(default)s)''')
+  p.add_argument('--no-store', action='store_true',
+      help="Don't record this run in the fare history.")
+  p.add_argument('-e', '--engine', choices=['browser', 'http'], default='browser',
+      help='''Drive Chrome, or issue the searches as plain HTTP requests
+      (no screenshots or JavaScript-rendered results). (default: browser)''')
+  p.add_argument('--record', metavar='DIR',
+      help='With the http engine, save every response to DIR.')
+  p.add_argument('--replay', metavar='DIR',
+      help='''With the http engine, answer every request from responses
+      saved by --record instead of the network.''')
+  p.add_argument('--proxy', metavar='HOST:PORT',
+      help='''With the http engine, send requests through this proxy, e.g. a
+      stand-in started with python -m flightscraper.httpengine.''')
+  p.add_argument('--health', default='~/.flightscraper/health.json',
+      help='''Where each airline's success rate, latency and circuit breaker
+      are kept between runs. (default: %(default)s)''')
+  p.add_argument('--tries', type=int, default=3,
+      help='Attempts per search before giving up on it. (default: 3)')
+  p.add_argument('--deadline', type=float, metavar='SECS',
+      help='''Time budget for the searches: once it's (nearly) spent, the
+      remaining ones are skipped rather than started.''')
+  p.add_argument('--resume', metavar='OUTDIR',
+      help='''Finish the run that wrote OUTDIR: redo only the searches its
+      journal has no results for, then report on all of them.''')
+  p.add_argument('--prometheus', metavar='FILE',
+      help='''Also write the run's timings (see profile.json in the output
+      directory) as FILE, for the Prometheus node exporter's textfile
+      collector.''')
+  p.add_argument('--lean', action='store_true',
+      help='''Lean page loads in the browser: don't load images, fonts or ad,
+      analytics and tag-manager scripts (see flightscraper.chrome).''')
+  p.add_argument('--block-host', action='append', default=[], metavar='GLOB',
+      help='Another third-party host (e.g. *.example.com) for --lean to block.')
+  p.add_argument('--lean-allow', action='append', default=[],
+      metavar='AIRLINE=GLOB',
+      help='''Something --lean would block (a host glob, or a file type like
+      *.woff) that AIRLINE's site needs.''')
+  p.add_argument('--daemon', metavar='SPOOL',
+      help='''Keep the browsers warm and run query spec jobs dropped into
+      SPOOL/new as they arrive (see flightscraper.daemon).''')
+  p.add_argument('--recycle', type=int, default=50,
+      help='With --daemon, restart each browser after this many jobs. (default: 50)')
+  p.add_argument('--poll', type=float, default=1,
+      help='''With --daemon, --work or --coordinate, seconds between checks
+      of the queue. (default: 1)''')
+  p.add_argument('--coordinate', metavar='QUEUE',
+      help='''Have workers on other nodes run the searches, through QUEUE: a
+      spool directory, or sqlite:PATH (see flightscraper.cluster).''')
+  p.add_argument('--work', metavar='QUEUE',
+      help="Search shards of coordinators' runs from QUEUE until killed.")
+  p.add_argument('--shard-size', type=int, default=10,
+      help='With --coordinate, searches per shard. (default: %(default)s)')
+  p.add_argument('--lease', type=float, default=120,
+      help='''Seconds without a heartbeat after which a worker's shard is
+      given to another. (default: %(default)s)''')
   cfg = p.parse_args(argv[1:])
+  cfg.now = now
+  if cfg.resume:
+    # A resumed run keeps its searches, run time and output directory.
+    prior = journal.load(path.path(cfg.resume))
+    cfg.routes, cfg.now, cfg.outdir = prior.routes, prior.now, cfg.resume
+    print 'resuming %s: %s searches done, %s failed' % (cfg.resume,
+        len(prior.done), len(prior.failed))
+  else:
+    cfg.routes = planner.load_spec(cfg.spec) if cfg.spec else planner.default_spec()
+  if not cfg.test and not cfg.daemon and not cfg.work:
+    queries = planner.plan(cfg.routes)
+    if cfg.plan:
+      for q in queries: print q.label
+    print planner.describe(cfg.routes, queries,
+        health.policy(os.path.expanduser(cfg.health), cfg.tries), cfg.workers)
+    if cfg.plan: return
   cfg.outdir = path.path(cfg.outdir)
   cfg.urlbase = path.path(cfg.urlbase)
+  cfg.cache = None if cfg.no_cache else \
+      cache.fare_cache(os.path.expanduser(cfg.cache_dir), cfg.max_age)
+  cfg.store = None if cfg.no_store else \
+      store.fare_store(os.path.expanduser(cfg.store))
+  cfg.watch = cfg.watch and alerts.load_watch(cfg.watch)
+  cfg.health = os.path.expanduser(cfg.health)
+  path.path(cfg.health).abspath().parent.makedirs_p()
+  cfg.page_profile = None
+  if cfg.lean and cfg.engine == 'browser':
+    from . import chrome
+    allow = {}
+    for arg in cfg.lean_allow:
+      airline, glob = arg.split('=', 1)
+      allow.setdefault(airline, []).append(glob)
+    cfg.page_profile = chrome.lean_profile(cfg.block_host, allow)
+  cfg.cluster = None
+  if cfg.coordinate:
+    from . import cluster
+    cfg.cluster = cluster.coordinator(cluster.open_queue(cfg.coordinate),
+                                      cfg.shard_size, cfg.lease, cfg.poll)
+  if cfg.work:
+    from . import cluster
+    return cluster.work(cfg)
+  if cfg.daemon:
+    from . import daemon
+    return daemon.serve(cfg)
   cfg.outdir.mkdir_p()
 
-  # find unused display; note TOCTTOU
-  for display in itr.count():
-    if not path.path('/tmp/.X11-unix/X%s' % display).exists():
-      break
-
+  # One connection for all of the run's mail.
+  mailer = alerts.mailer(cfg.smtp)
   try:
-    cmd = 'sleep 99999999' if cfg.debug else 'Xvfb :%s -screen 0 1600x1200x24' % display
-    with subproc(cmd.split()) as xvfb:
-      if not cfg.debug: os.environ['DISPLAY'] = ':%s' % display
-      # This silencing isn't working
-      stdout, stderr = sys.stdout, sys.stderr
-      sys.stdout = open('/dev/null','w')
-      sys.stderr = open('/dev/null','w')
-      with quitting(webdriver.Chrome()) as wd:
-        sys.stdout, sys.stderr = stdout, stderr
-        email_text, email_html, raw_res = script(wd, cfg)
-
-    with open(cfg.outdir / 'results.pickle', 'w') as f: pickle.dump(raw_res, f, 2)
-
-    if cfg.mailto:
-      mail = MIMEMultipart('alternative')
-      mail['From'] = cfg.mailfrom
-      mail['To'] = cfg.mailto
-      mail['Subject'] = 'Flight Scraper Results for %s' % fmt_time(now)
-      mail.attach(MIMEText(email_text, 'plain'))
-      mail.attach(MIMEText(email_html, 'html'))
-      with contextlib.closing(smtplib.SMTP('localhost')) as smtp:
-        smtp.sendmail(mail['From'], mail['To'].split(','), mail.as_string())
+    if cfg.test or cfg.cluster:
+      # Fake data, or searches run by cluster workers: no sessions needed.
+      email_text, email_html, by_route, changes = script([], cfg)
+    elif cfg.engine == 'http':
+      with http_sessions(cfg) as ss:
+        email_text, email_html, by_route, changes = script(ss, cfg)
+    else:
+      from . import chrome
+      displays = chrome.free_displays(cfg.workers)
+      with contextlib.nested(*[chrome.browser(display, cfg.debug, cfg.page_profile,
+                                              cfg.tabs == 1)
+                               for display in displays]) as wds:
+        email_text, email_html, by_route, changes = script(wds, cfg)
+
+    save_results(cfg, email_text, email_html, by_route)
+    notify(cfg, email_text, email_html, changes, mailer)
   except:
     msg = '%s\n\n%s' % (traceback.format_exc(),
         cfg.urlbase / urllib.quote(cfg.outdir))
+    if (cfg.outdir / journal.name).exists():
+      msg += '\n\nTo finish this run: flightscraper --resume %s' % cfg.outdir
     mail = MIMEText(msg, 'plain')
     mail['From'] = cfg.mailfrom
     mail['To'] = cfg.mailto
-    mail['Subject'] = 'Flight Scraper Error for %s' % fmt_time(now)
-    with contextlib.closing(smtplib.SMTP('localhost')) as smtp:
-      smtp.sendmail(mail['From'], mail['To'].split(','), mail.as_string())
+    mail['Subject'] = 'Flight Scraper Error for %s' % fmt_time(cfg.now)
+    mailer.send(mail)
+  finally:
+    mailer.close()
@@ -0,0 +1,78 @@
+"""
+Registry of airline adapters: what each airline's search covers and what it
+costs, which the planner (flightscraper.planner) plans calls with and the
+searcher schedules them by.
+
+An airline's search functions are found by its name, in fs.airlines for the
+browser engine and flightscraper.httpengine.airlines for the http one, unless
+its adapter is given them.  To add an airline, write its search function(s),
+wrapped in fs.retry_if_timeout like the others, and register an adapter for
+it; nothing else needs to know about it.
+
+What a call costs is taken from the airline's health (see
+flightscraper.health): its observed latency, inflated by its failure rate
+for the retries it will likely need.  Until it has been searched, the
+adapter's own estimate stands in.
+"""
+
+import collections
+import flightscraper as fs
+
+class adapter(object):
+  """
+  coverage is what one call returns: the 'month' around its date, a 'week'
+  (+/- 3 days around it), or just that 'day'.  est_secs is a rough time per
+  call (page load, form fill, results).  nearby_kw turns on the airline's own
+  nearby-airport search; with alt_orgs, it has none and each alternate origin
+  gets a call of its own instead.  airports are those the airline flies from
+  or to, or None for any.  An airline that doesn't share_session must have
+  its browser to itself while searching, rather than sharing it with other
+  tabs' searches.
+  """
+  def __init__(self, name, coverage, est_secs=60, nearby_kw={}, alt_orgs=False,
+               airports=None, share_session=True, browser=None, http=None):
+    if coverage not in ('month', 'week', 'day'):
+      raise ValueError('unknown coverage %r' % coverage)
+    self.name, self.coverage, self.est_secs = name, coverage, est_secs
+    self.nearby_kw, self.alt_orgs = nearby_kw, alt_orgs
+    self.airports = airports and set(a.lower() for a in airports)
+    self.share_session = share_session
+    self.browser, self.http = browser, http
+  def serves(self, org, dst):
+    return self.airports is None or (org in self.airports and dst in self.airports)
+  def search(self, engine):
+    """The airline's search function for engine ('browser' or 'http')."""
+    if engine == 'http':
+      if self.http: return self.http
+      from . import httpengine
+      return httpengine.airlines[self.name]
+    return self.browser or fs.airlines[self.name]
+  def cost(self, policy):
+    """
+    Expected seconds per call under the health policy: the observed latency
+    (or est_secs), times the attempts the observed success rate implies, up
+    to policy.tries.
+    """
+    h = policy.airlines.get(self.name)
+    if h is None or h.latency is None: secs = self.est_secs
+    else: secs = h.latency
+    fail = 1. - (h.rate if h else 1.)
+    return secs * sum(fail ** i for i in xrange(policy.tries))
+
+registry = collections.OrderedDict()
+
+def register(a):
+  """Adds (or replaces) adapter a; returns it."""
+  registry[a.name] = a
+  return a
+
+def get(name):
+  try: return registry[name]
+  except KeyError: raise ValueError('unknown airline %r' % name)
+
+register(adapter('united', 'month', 45, dict(nearby=True)))
+register(adapter('aa', 'week', 40, dict(dist_org=60, dist_dst=30)))
+register(adapter('virginamerica', 'week', 30))
+register(adapter('bing', 'day', 35, dict(near_org=True, near_dst=True)))
+register(adapter('southwest', 'month', 30, alt_orgs=True))
+register(adapter('delta', 'day', 30, dict(nearby=True)))
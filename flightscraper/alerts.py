@@ -0,0 +1,142 @@
+"""
+Fare-change alerts.  Each run's cheapest price per route and travel date is
+compared with the previous run's (from the fare store), and only the dates
+whose price moved are passed on: to subscribers whose watch rules they
+match, batched into one message per subscriber, all sent over one SMTP
+connection.
+
+A watch file (--watch) is JSON mapping subscriber email addresses to lists
+of rules, e.g.
+
+  {"alice@example.com": [{"route": "sfo-phl", "below": 250},
+                         {"drop": 15}],
+   "bob@example.com": [{"route": "sjc-phl", "dates": ["2012-12-20",
+                                                     "2012-12-24"],
+                        "drop": 10}]}
+
+A rule's route (ORG-DST) and dates (first and last, inclusive) narrow it
+down, if given.  "below" fires when a date's price falls to a new low under
+it (a date first seen under it counts), "drop" when it falls by at least that
+percentage since the previous run.
+
+To try the alerts without a mail server, run a debugging one, which prints
+the messages it's sent instead of delivering them:
+
+  python -m smtpd -n -c DebuggingServer localhost:1025
+
+and point flightscraper at it with --smtp localhost:1025.
+"""
+
+import collections, json, logging, smtplib, urllib
+from email.mime.text import MIMEText
+import flightscraper as fs
+from . import store
+
+class change(collections.namedtuple('change', 'org dst date old new')):
+  """A travel date's cheapest price moving between runs; old is None if new."""
+  __slots__ = ()
+  def pct(self):
+    return None if self.old is None else 100. * (self.new - self.old) / self.old
+  def describe(self):
+    s = '%s to %s on %s: $%s' % (self.org.upper(), self.dst.upper(),
+                                 self.date.strftime('%a %Y-%m-%d'), self.new)
+    if self.old is None: return s + ' (new)'
+    return s + ' (was $%s, %+.0f%%)' % (self.old, self.pct())
+
+def minimums(fares, labels=None):
+  """
+  Travel date -> cheapest price among fares ((label, date, price)), counting
+  only those of labels if given.
+  """
+  out = {}
+  for label, date, prc in fares:
+    if labels is not None and label not in labels: continue
+    if date not in out or prc < out[date]: out[date] = prc
+  return out
+
+def changes(fare_store, now, by_route):
+  """
+  The changes, route by route, in by_route ((org, dst) -> raw_res) since the
+  last run before now recorded in fare_store (if any; without one every
+  date is new).  Only the searches with results in both runs count, so a
+  search that failed in either doesn't make a date's price seem to move.
+  Dates that have dropped out of the results aren't changes.
+  """
+  out = []
+  for (org, dst), raw_res in sorted(by_route.iteritems()):
+    cur = [(label, date, prc) for group, (label, res) in raw_res
+           for prc, date in res]
+    prev = fare_store.previous(org, dst, now) if fare_store else []
+    both = set(f[0] for f in cur) & set(f[0] for f in prev) if prev else None
+    old = minimums(prev, both)
+    for date, prc in sorted(minimums(cur, both).iteritems()):
+      if old.get(date) != prc:
+        out.append(change(org.lower(), dst.lower(), date, old.get(date), prc))
+  return out
+
+class rule(object):
+  def __init__(self, route=None, dates=None, below=None, drop=None):
+    if below is None and drop is None:
+      raise ValueError('watch rule needs "below" or "drop"')
+    self.route = route and tuple(route.lower().split('-'))
+    self.dates = dates and [store.parse_iso(d) for d in dates]
+    self.below, self.drop = below, drop
+  def matches(self, c):
+    if self.route and self.route != (c.org, c.dst): return False
+    if self.dates and not self.dates[0] <= c.date <= self.dates[-1]: return False
+    lower = c.old is None or c.new < c.old
+    if self.below is not None and c.new < self.below and lower: return True
+    return self.drop is not None and c.old is not None and -c.pct() >= self.drop
+
+def load_watch(f):
+  """Subscriber -> [rule] from watch file f (see above)."""
+  return dict((who, [rule(**dict((str(k), v) for k, v in r.iteritems()))
+                     for r in rules])
+              for who, rules in json.load(f).iteritems())
+
+def matching(watch, changes):
+  """Subscriber -> the changes matching any of their rules, for those with any."""
+  out = {}
+  for who, rules in sorted(watch.iteritems()):
+    hits = [c for c in changes if any(r.matches(c) for r in rules)]
+    if hits: out[who] = hits
+  return out
+
+class mailer(object):
+  """
+  Sends a run's messages over one SMTP connection to server (HOST[:PORT]),
+  opened with the first message and reopened if the server drops it.
+  """
+  def __init__(self, server='localhost'):
+    host, _, port = server.partition(':')
+    self.host, self.port = host, int(port or smtplib.SMTP_PORT)
+    self.smtp = None
+  def send(self, msg):
+    to = [a.strip() for a in msg['To'].split(',')]
+    for attempt in xrange(2):
+      if self.smtp is None: self.smtp = smtplib.SMTP(self.host, self.port)
+      try:
+        self.smtp.sendmail(msg['From'], to, msg.as_string())
+        break
+      except smtplib.SMTPServerDisconnected:
+        self.smtp = None
+        if attempt: raise
+  def close(self):
+    if self.smtp is None: return
+    try: self.smtp.quit()
+    except smtplib.SMTPException: pass
+    self.smtp = None
+
+def deliver(cfg, changes, mailer):
+  """Mails each of cfg.watch's subscribers their matching changes, if any."""
+  report_url = cfg.urlbase / urllib.quote(cfg.outdir) / fs.html_path
+  for who, hits in sorted(matching(cfg.watch, changes).iteritems()):
+    best = min(hits, key=lambda c: c.new)
+    mail = MIMEText('\n'.join(c.describe() for c in hits) +
+                    '\n\n%s\n' % report_url, 'plain')
+    mail['From'] = cfg.mailfrom
+    mail['To'] = who
+    mail['Subject'] = 'Fare alert: %s change%s, from $%s' % (
+        len(hits), '' if len(hits) == 1 else 's', best.new)
+    mailer.send(mail)
+    logging.info('alerted %s of %s change(s)', who, len(hits))
@@ -0,0 +1,267 @@
+"""
+Price-history analytics over fare observations held in numpy columns: per-day
+minima, rolling lows, per-label spreads and price-drop detection, computed in
+bulk, plus plotting that decimates long series before drawing them.
+
+Observations can come from the mbox of emailed reports (what plot.py used to
+scan), plot.py's old CSV output, results.pickle output directories, or the
+fare store.
+"""
+
+import argparse, csv, datetime as dt, re, sys, time, path
+import numpy as np
+from . import store
+
+day = 86400
+
+class observations(object):
+  """
+  Columns of equal length: observed (unix time of the run), date (travel
+  date as an ordinal, 0 if unknown), prc, and label (an index into labels).
+  """
+  def __init__(self, observed, date, prc, label, labels):
+    self.observed = np.asarray(observed, dtype=np.float64)
+    self.date = np.asarray(date, dtype=np.int32)
+    self.prc = np.asarray(prc, dtype=np.float64)
+    self.label = np.asarray(label, dtype=np.int32)
+    self.labels = list(labels)
+  def __len__(self): return len(self.prc)
+  @classmethod
+  def from_rows(cls, rows):
+    """rows: iterable of (observed datetime, travel date or None, price, label)."""
+    ids = {}
+    cols = ([], [], [], [])
+    for observed, date, prc, label in rows:
+      cols[0].append(store.timestamp(observed))
+      cols[1].append(date.toordinal() if date else 0)
+      cols[2].append(prc)
+      cols[3].append(ids.setdefault(label, len(ids)))
+    return cls(*cols, labels=sorted(ids, key=ids.get))
+  def where(self, mask):
+    return observations(self.observed[mask], self.date[mask], self.prc[mask],
+                        self.label[mask], self.labels)
+
+# Loaders
+
+nums = re.compile(r'\$(\d+)')
+
+def from_mbox(lines):
+  """
+  One observation per price in each emailed report, labelled 'email'.  Travel
+  dates aren't recoverable from the text calendar, so they're unknown.
+  """
+  def gen():
+    observed = None
+    for line in lines:
+      if line.startswith('From '):
+        stamp = line.split('  ', 1)[1].strip()
+        observed = dt.datetime.fromtimestamp(time.mktime(
+          time.strptime(stamp, '%a %b %d %H:%M:%S %Y')))
+      elif observed is not None:
+        for m in nums.finditer(line):
+          yield observed, None, int(m.group(1)), 'email'
+  return observations.from_rows(gen())
+
+def from_csv(lines):
+  """plot.py's old output: (timestamp, cheapest price) rows."""
+  def gen():
+    for stamp, prc in csv.reader(lines):
+      observed = dt.datetime.fromtimestamp(time.mktime(
+        time.strptime(stamp, '%a %b %d %H:%M:%S %Y')))
+      yield observed, None, float(prc), 'email'
+  return observations.from_rows(gen())
+
+def from_pickles(outdirs, route=None):
+  """
+  The fares in outdirs' results.pickle files: route's (org, dst) only, if
+  given (plus those of old single-route runs), else every route's, with the
+  route prepended to the labels of runs that searched several.
+  """
+  def gen():
+    for outdir in map(path.path, outdirs):
+      p = outdir / 'results.pickle'
+      if not p.exists(): continue
+      observed = store.run_time(outdir)
+      by_route = store.load_results(p)
+      for r, raw_res in sorted(by_route.iteritems()):
+        if route and r not in (None, route): continue
+        prefix = '' if route or r is None or len(by_route) == 1 else \
+                 '%s-%s ' % r
+        for group, (label, res) in raw_res:
+          for prc, date in res:
+            yield observed, date, prc, prefix + label
+  return observations.from_rows(gen())
+
+def from_store(fares, org, dst):
+  rows = fares.db.execute('select observed, date, prc, label from fares '
+                          'where org = ? and dst = ?', (org.lower(), dst.lower()))
+  labels = {}
+  cols = ([], [], [], [])
+  for observed, date, prc, label in rows:
+    cols[0].append(observed)
+    cols[1].append(store.parse_iso(date).toordinal())
+    cols[2].append(prc)
+    cols[3].append(labels.setdefault(label, len(labels)))
+  return observations(*cols, labels=sorted(labels, key=labels.get))
+
+# Analytics
+
+def group_min(keys, vals):
+  """Returns (unique keys, min of vals per key)."""
+  if len(keys) == 0: return keys, vals
+  order = np.lexsort((vals, keys))
+  keys, vals = keys[order], vals[order]
+  first = np.concatenate(([True], keys[1:] != keys[:-1]))
+  return keys[first], vals[first]
+
+def run_minima(obs):
+  """(observed, cheapest price) per run, as plot.py used to report."""
+  return group_min(obs.observed, obs.prc)
+
+def daily_minima(obs, by='observed'):
+  """
+  Cheapest price per day, either per day observed (as days since the epoch)
+  or per travel date (as ordinals).
+  """
+  if by == 'observed': return group_min((obs.observed // day).astype(np.int64), obs.prc)
+  known = obs.date > 0
+  return group_min(obs.date[known], obs.prc[known])
+
+def rolling_low(days, mins, window=7, before=False):
+  """
+  Lowest price over the trailing window days at each of days (which must be
+  sorted, as daily_minima returns them), or with before over the window days
+  ending the day before; inf where the window has no observations.  Days
+  with no observations don't count towards the window, but don't break it
+  either.
+  """
+  if len(days) == 0: return np.empty(0, dtype=np.float64)
+  dense = np.empty(days[-1] - days[0] + window + before, dtype=np.float64)
+  dense.fill(np.inf)
+  dense[days - days[0] + window - 1 + before] = mins
+  # Row i of the strided view is dense[i:i+window], the window ending at day i.
+  strided = np.lib.stride_tricks.as_strided(dense,
+      shape=(len(dense) - window + 1, window), strides=dense.strides * 2)
+  return strided.min(axis=1)[days - days[0]]
+
+def spreads(obs):
+  """
+  Per label: (label, n, min, median, max, max - min).
+  """
+  order = np.lexsort((obs.prc, obs.label))
+  label, prc = obs.label[order], obs.prc[order]
+  starts = np.flatnonzero(np.concatenate(([True], label[1:] != label[:-1])))
+  ends = np.concatenate((starts[1:], [len(label)]))
+  lo, hi = prc[starts], prc[ends - 1]
+  med = (prc[(starts + ends - 1) // 2] + prc[(starts + ends) // 2]) / 2
+  return [(obs.labels[l], e - s, a, m, b, b - a) for l, s, e, a, m, b in
+          zip(label[starts], starts, ends, lo, med, hi)]
+
+def drops(days, mins, pct=10, window=7):
+  """
+  Indices into days where the price fell more than pct percent below the
+  previous window days' low.  Days with no observations in their previous
+  window aren't drops.
+  """
+  if len(days) == 0: return np.empty(0, dtype=np.intp)
+  prev = rolling_low(days, mins, window, before=True)
+  with np.errstate(invalid='ignore'):
+    return np.flatnonzero(np.isfinite(prev) & (mins < prev * (1 - pct / 100.)))
+
+# Plotting
+
+def decimate(x, y, buckets=2000):
+  """
+  Shrinks a long series to at most 2 * buckets points, keeping each bucket's
+  min and max so spikes and dips survive.
+  """
+  if len(x) <= 2 * buckets: return x, y
+  n = len(x) // buckets * buckets
+  xs, ys = x[:n].reshape(buckets, -1), y[:n].reshape(buckets, -1)
+  rows = np.arange(buckets)
+  lo, hi = ys.argmin(axis=1), ys.argmax(axis=1)
+  first, second = np.minimum(lo, hi), np.maximum(lo, hi)
+  x = np.column_stack((xs[rows, first], xs[rows, second])).ravel()
+  y = np.column_stack((ys[rows, first], ys[rows, second])).ravel()
+  return x, y
+
+# matplotlib's date number for the unix epoch
+epoch_datenum = dt.date(1970, 1, 1).toordinal()
+
+def plot(obs, out, window=7, buckets=600):
+  """
+  Writes a plot of every label's cheapest price per run, plus the overall
+  rolling low, against time observed.
+  """
+  import matplotlib
+  matplotlib.use('Agg')
+  import matplotlib.pyplot as plt
+  fig, ax = plt.subplots(figsize=(12, 6))
+  for l, label in enumerate(obs.labels):
+    observed, mins = run_minima(obs.where(obs.label == l))
+    ax.plot(*decimate(observed / day + epoch_datenum, mins, buckets),
+            label=label, lw=.8, alpha=.6)
+  days, mins = daily_minima(obs)
+  if len(days):
+    ax.plot(*decimate(days + epoch_datenum, rolling_low(days, mins, window), buckets),
+            label='%s-day low' % window, lw=2, color='k')
+  ax.xaxis_date()
+  ax.set_ylabel('price ($)')
+  if len(obs.labels) <= 20: ax.legend(loc='best', fontsize='small')
+  fig.savefig(out, dpi=100)
+  plt.close(fig)
+
+def fmt_day(d): return dt.date.fromordinal(epoch_datenum + int(d))
+
+def main(argv=sys.argv):
+  p = argparse.ArgumentParser(description='Analyze fare history.  Without '
+      'inputs, reads an mbox of emailed reports on stdin.')
+  p.add_argument('outdirs', nargs='*', help='Output directories with results.pickle.')
+  p.add_argument('--mbox', type=argparse.FileType('r'), help='mbox of emailed reports.')
+  p.add_argument('--csv', type=argparse.FileType('r'), help="plot.py's old CSV output.")
+  p.add_argument('--store', help='Fare store database; requires --route.')
+  p.add_argument('--route', nargs=2, metavar=('ORG', 'DST'),
+      help="Route to read from --store, and the only one of the output "
+           "directories' to read.")
+  p.add_argument('--plot', metavar='PNG', help='Write a plot here.')
+  p.add_argument('--window', type=int, default=7, help='Rolling low window (days).')
+  p.add_argument('--drops', type=float, metavar='PCT',
+      help='List days whose low fell more than PCT percent under the rolling low.')
+  p.add_argument('--spreads', action='store_true', help='Print per-label spreads.')
+  cfg = p.parse_args(argv[1:])
+
+  parts = []
+  route = cfg.route and tuple(a.lower() for a in cfg.route)
+  if cfg.outdirs: parts.append(from_pickles(cfg.outdirs, route))
+  if cfg.mbox: parts.append(from_mbox(cfg.mbox))
+  if cfg.csv: parts.append(from_csv(cfg.csv))
+  if cfg.store: parts.append(from_store(store.fare_store(cfg.store), *cfg.route))
+  if not parts: parts.append(from_mbox(sys.stdin))
+  obs = parts[0] if len(parts) == 1 else concat(parts)
+
+  w = csv.writer(sys.stdout)
+  if cfg.spreads:
+    for row in spreads(obs): w.writerow(row)
+  elif cfg.drops is not None:
+    days, mins = daily_minima(obs)
+    for i in drops(days, mins, cfg.drops, cfg.window):
+      w.writerow((fmt_day(days[i]), mins[i]))
+  elif not cfg.plot:
+    for observed, prc in zip(*run_minima(obs)):
+      w.writerow((time.ctime(observed), int(prc)))
+  if cfg.plot: plot(obs, cfg.plot, cfg.window)
+
+def concat(parts):
+  labels = []
+  for part in parts:
+    labels.extend(l for l in part.labels if l not in labels)
+  ids = dict((l, i) for i, l in enumerate(labels))
+  return observations(
+      np.concatenate([part.observed for part in parts]),
+      np.concatenate([part.date for part in parts]),
+      np.concatenate([part.prc for part in parts]),
+      np.concatenate([np.array([ids[l] for l in part.labels], dtype=np.int32)[part.label]
+                      for part in parts]),
+      labels)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,74 @@
+"""
+On-disk cache of airline search results, so that runs asking the same
+question within an airline's TTL skip the browser entirely.
+"""
+
+import cPickle as pickle, datetime as dt, hashlib, os, time, path
+
+# How long (seconds) a result stays fresh, per airline.  The month-grid
+# airlines are slow to scrape and their grids move slowly; the single-day
+# searches are cheaper to redo.
+ttls = dict(united=6*3600, southwest=6*3600, aa=3*3600, virginamerica=3*3600,
+            bing=3600, delta=3600)
+default_ttl = 3600
+
+def normalize(x):
+  """
+  Canonical form of a search argument, so that e.g. 'SFO' and 'sfo' or
+  kwargs given in a different order hit the same entry.
+  """
+  if isinstance(x, basestring): return x.lower()
+  if isinstance(x, dt.date): return x.isoformat()
+  if isinstance(x, (list, tuple)): return tuple(map(normalize, x))
+  if isinstance(x, dict):
+    return tuple(sorted((k, normalize(v)) for k, v in x.iteritems()))
+  return x
+
+def key(airline, args, kw):
+  return hashlib.sha1(repr((airline, normalize(args), normalize(kw)))).hexdigest()
+
+class fare_cache(object):
+  """
+  One pickle per (airline, args, kw) under dir.  Entries older than the
+  airline's TTL (capped by max_age, if given) are misses.  Once the entries
+  take up more than max_bytes, the least recently used ones are evicted; a hit
+  refreshes an entry's mtime for this.
+  """
+  def __init__(self, dir, max_age=None, max_bytes=64 << 20):
+    self.dir = path.path(dir)
+    self.dir.makedirs_p()
+    self.max_age = max_age
+    self.max_bytes = max_bytes
+  def ttl(self, airline):
+    ttl = ttls.get(airline, default_ttl)
+    return ttl if self.max_age is None else min(ttl, self.max_age)
+  def get(self, airline, args, kw):
+    """
+    Returns the cached [(price, date)] for this search, or None.
+    """
+    p = self.dir / key(airline, args, kw)
+    try:
+      with open(p, 'rb') as f: stamp, res = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError): return None
+    if time.time() - stamp > self.ttl(airline): return None
+    os.utime(p, None)
+    return res
+  def put(self, airline, args, kw, res):
+    p = self.dir / key(airline, args, kw)
+    tmp = '%s.%s.tmp' % (p, os.getpid())
+    with open(tmp, 'wb') as f: pickle.dump((time.time(), res), f, 2)
+    os.rename(tmp, p)
+    self.evict()
+  def evict(self):
+    entries = []
+    for p in self.dir.files():
+      if p.endswith('.tmp'): continue
+      try: st = os.stat(p)
+      except OSError: continue
+      entries.append((st.st_mtime, st.st_size, p))
+    total = sum(size for _, size, _ in entries)
+    for _, size, p in sorted(entries):
+      if total <= self.max_bytes: break
+      try: os.remove(p)
+      except OSError: pass
+      total -= size
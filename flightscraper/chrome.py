@@ -0,0 +1,394 @@
+"""
+The browser side of scraping: Chrome sessions on Xvfb displays, driven through
+selenium with the lookup helpers the airline functions use.  Imported only
+when searches actually run in a browser, so reports, --test and the http
+engine never load selenium.
+"""
+
+from selenium import webdriver
+from selenium.webdriver.common.keys import Keys
+from selenium.common.exceptions import NoSuchElementException, WebDriverException
+import contextlib, functools, itertools as itr, ludibrio, os, subprocess, sys, \
+    threading, time, path
+import flightscraper as fs
+from . import timing
+
+def retry_if_nexist(multireturn=False):
+  """
+  Retries the lookup with backoff until the element shows up.  Each lookup's
+  total wait is appended to the driver's waits as (method, selector,
+  seconds).  maxsec is wall time, so with tabs it includes time other tabs
+  spend driving the browser.
+  """
+  def dec(f):
+    @functools.wraps(f)
+    def wrapper(self, x, retry = True, maxsec = 60, dummy = True, permit_none = False, **kw):
+      start = time.time()
+      maxsec = fs.health.current.wait_budget(maxsec)
+      try:
+        for delay in fs.backoff():
+          try:
+            # After a submit, the page to look on is the results page.
+            if not self.settled(): raise NoSuchElementException()
+            res = f(self, x, **kw)
+            # Multiple selectors at once (see extract) need every one to match.
+            if multireturn and not permit_none and \
+                (res == [] or type(res) is tuple and [] in res):
+              raise NoSuchElementException()
+            return res
+          except NoSuchElementException:
+            if not retry: return ludibrio.Dummy() if dummy else None
+            if time.time() - start > maxsec:
+              timing.count('lookup_timeouts')
+              raise fs.timeout_exception()
+            timing.count('lookup_retries')
+            # Once the form's submitted, waiting on elements is waiting on
+            # the results.
+            if timing.current_phase() in ('submit', 'extract'): timing.phase('wait')
+            fs.sleep(delay)
+      finally:
+        self.waits.append((f.__name__, x, time.time() - start))
+    return wrapper
+  return dec
+
+class rich_driver(object):
+  """
+  With a browser that doesn't wait for page loads (see browser), navigating
+  and submitting return at once, and what comes after waits for the new page
+  by polling (so in fs.sleep, letting other tabs drive meanwhile).
+  """
+  def __init__(self, wd, debug):
+    self.wd = wd
+    self.debug = debug
+    self.waits = []
+    self.blocking = wd.capabilities.get('pageLoadStrategy') != 'none'
+    # When the page was last left or submitted, until the next one's loaded.
+    self.leaving = None
+  def __getattr__(self, attr): return getattr(self.wd, attr)
+  def watch(self, leaving):
+    """
+    Starts watching for the page to be left (or, if leaving, as left), just
+    before navigating or submitting.
+    """
+    if self.blocking: return
+    self.wd.execute_script(watch_js, leaving)
+    self.leaving = time.time()
+  def settled(self):
+    """
+    Whether the page watched for leaving has been left for one that's
+    loaded, or has stayed put for a second (its results come in by AJAX).
+    """
+    if self.leaving is None: return True
+    try: state = self.wd.execute_script(state_js)
+    except WebDriverException: return False # between pages
+    if state == 'complete' or state == 'stayed' and time.time() - self.leaving > 1:
+      self.leaving = None
+    return self.leaving is None
+  def get(self, url):
+    timing.phase('navigate')
+    self.watch(True)
+    self.wd.get(url)
+    if not fs.wait_until(self.settled, fs.health.current.wait_budget(60)):
+      raise fs.timeout_exception()
+    self.count_bytes()
+    timing.phase('fill')
+  def count_bytes(self):
+    """
+    Counts what the current page has transferred since last counted, for
+    the report's page data column (and lean mode's savings).  Done after
+    loading the form, on submitting it and once the search has its results.
+    """
+    try: timing.count('page_bytes', self.wd.execute_script(page_bytes_js) or 0)
+    except WebDriverException: pass
+  def ckpt(self):
+    """Callback from an airline function after filling but before submitting
+    the form.  Useful if you want to take a screenshot, make some edits,
+    etc.  Overrides should call this last; it starts the submit phase."""
+    timing.phase('submit')
+  @retry_if_nexist()
+  def xpath(self, x): return rich_web_elt(self.wd.find_element_by_xpath(x), self)
+  @retry_if_nexist(True)
+  def xpaths(self, x): return map(rich_web_elt, self.wd.find_elements_by_xpath(x))
+  @retry_if_nexist()
+  def getid(self, x): return rich_web_elt(self.wd.find_element_by_id(x), self)
+  @retry_if_nexist()
+  def name(self, x): return rich_web_elt(self.xpath('//*[@name=%r]' % (x,)))
+  @retry_if_nexist()
+  def css(self, x): return rich_web_elt(self.wd.find_element_by_css_selector(x), self)
+  @retry_if_nexist(True)
+  def csss(self, x): return map(rich_web_elt, self.wd.find_elements_by_css_selector(x))
+  @retry_if_nexist(True)
+  def extract(self, x, fields=('text',)):
+    """
+    Reads fields off every element matching CSS selector x in a single
+    round-trip, rather than one per element and attribute.  Returns a list
+    with a list of values per element.  A field is 'text' for the element's
+    text, '@name' for an attribute, or a CSS selector for the text of the
+    element's first matching descendant (None if there's none).  If x is a
+    tuple of selectors, returns a tuple of such lists, still in one
+    round-trip.
+    """
+    xs = x if type(x) is tuple else (x,)
+    timing.phase('extract')
+    res = self.wd.execute_script(extract_js, list(xs), list(fields))
+    return tuple(res) if type(x) is tuple else res[0]
+
+# Mirrors WebElement.text: visible text, with runs of spaces and blank lines
+# collapsed and the ends trimmed.
+extract_js = r'''
+var sels = arguments[0], fields = arguments[1];
+function text(e) {
+  return (e.innerText || '').replace(/[ \t\u00a0]+/g, ' ')
+    .replace(/ *\n\s*/g, '\n').replace(/^\s+|\s+$/g, '');
+}
+return sels.map(function(sel) {
+  return Array.prototype.map.call(document.querySelectorAll(sel), function(e) {
+    return fields.map(function(field) {
+      if (field == 'text') return text(e);
+      if (field.charAt(0) == '@') return e.getAttribute(field.slice(1));
+      var sub = e.querySelector(field);
+      return sub ? text(sub) : null;
+    });
+  });
+});
+'''
+
+# Marks the page for rich_driver.settled: its leaving is noticed (the
+# navigation's start fires beforeunload) or, given arguments[0], assumed.
+watch_js = r'''
+window.fsWatched = true;
+window.fsLeaving = arguments[0];
+window.addEventListener('beforeunload', function() { window.fsLeaving = true; });
+'''
+# The watched page's 'leaving' or 'stayed', else the new page's readyState.
+state_js = r'''
+if (!window.fsWatched) return document.readyState;
+return window.fsLeaving ? 'leaving' : 'stayed';
+'''
+
+# Bytes the current page has transferred since it was last asked, per the
+# resource timing API (0 where the browser doesn't report transfer sizes).
+page_bytes_js = r'''
+if (!performance.getEntriesByType) return 0;
+var es = performance.getEntriesByType('navigation')
+    .concat(performance.getEntriesByType('resource')), n = 0;
+for (var i = 0; i < es.length; i++) n += es[i].transferSize || 0;
+var d = n - (window.fsCounted || 0);
+window.fsCounted = n;
+return d;
+'''
+
+# What lean page loads (--lean) block: images and fonts, which no airline
+# function looks at, and the hosts of ad, analytics and tag-manager scripts.
+lean_images = ['*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.svg', '*.ico']
+lean_types = lean_images + ['*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot']
+lean_hosts = ['*.doubleclick.net', '*.googlesyndication.com',
+              '*.google-analytics.com', '*.googletagmanager.com',
+              '*.facebook.net', '*.omtrdc.net', '*.demdex.net',
+              '*.adobedtm.com', '*.scorecardresearch.com', '*.quantserve.com',
+              '*.hotjar.com', '*.optimizely.com', '*.krxd.net', '*.criteo.com',
+              '*.adnxs.com', '*.mathtag.com', '*.nr-data.net']
+# Per airline, the lean_types or host globs its site breaks without, e.g.
+# dict(delta=['*.adobedtm.com']); added to with --lean-allow.
+lean_allow = {}
+
+class lean_profile(object):
+  """
+  The page-load profile of lean mode: lean_types and the hosts (lean_hosts
+  plus extra ones) are blocked, except for what allow (merged into
+  lean_allow) lets through on an airline's site.
+
+  Blocking per airline goes through the DevTools protocol, which needs a
+  chromedriver that forwards it; Chrome's launch options cover the rest (the
+  images setting, and resolving the hosts no airline needs to nowhere), so
+  older chromedrivers still get most of the savings.
+  """
+  def __init__(self, hosts=(), allow={}):
+    self.hosts = lean_hosts + list(hosts)
+    self.allow = dict((a, list(globs)) for a, globs in lean_allow.iteritems())
+    for a, globs in allow.iteritems(): self.allow.setdefault(a, []).extend(globs)
+    self.cdp = True
+  def allowed(self):
+    return set(g for globs in self.allow.itervalues() for g in globs)
+  def blocked(self, airline):
+    """URL patterns to block on airline's site."""
+    allow = set(self.allow.get(airline, ()))
+    return [t for t in lean_types if t not in allow] + \
+           ['*://%s/*' % h for h in self.hosts if h not in allow]
+  def options(self):
+    opts = webdriver.ChromeOptions()
+    allowed = self.allowed()
+    if not allowed & set(lean_images):
+      opts.add_experimental_option('prefs',
+          {'profile.managed_default_content_settings.images': 2})
+    rules = ['MAP %s ~NOTFOUND' % h for h in self.hosts if h not in allowed]
+    if rules: opts.add_argument('--host-resolver-rules=%s' % ', '.join(rules))
+    return opts
+  def apply(self, wd, airline):
+    """Sets up wd to block what lean mode blocks on airline's site."""
+    if not self.cdp: return
+    try:
+      cdp(wd, 'Network.enable')
+      cdp(wd, 'Network.setBlockedURLs', urls=self.blocked(airline))
+    except WebDriverException:
+      self.cdp = False
+
+def cdp(wd, cmd, **params):
+  """Runs a DevTools protocol command in wd's browser."""
+  wd.command_executor._commands.setdefault(
+      'executeCdpCommand', ('POST', '/session/$sessionId/goog/cdp/execute'))
+  return wd.execute('executeCdpCommand', dict(cmd=cmd, params=params))['value']
+
+class rich_web_elt(object):
+  """
+  An element, found by drv if given.  Clicking or submitting it once the
+  form's filled (see rich_driver.ckpt) has drv watch for the results page.
+  """
+  def __init__(self, elt, drv=None):
+    self.elt, self.drv = elt, drv
+  def submitting(self):
+    if self.drv and timing.current_phase() == 'submit':
+      self.drv.count_bytes()
+      self.drv.watch(False)
+  def clear(self):
+    self.elt.clear()
+    return self
+  def click(self):
+    self.submitting()
+    self.elt.click()
+    return self
+  def submit(self):
+    self.submitting()
+    self.elt.submit()
+    return self
+  def send_keys(self, keys):
+    self.elt.send_keys(keys)
+    return self
+  def delay(self, delay = 1):
+    fs.sleep(delay)
+    return self
+  def tab(self):
+    self.elt.send_keys(Keys.TAB)
+    return self
+  def enter(self):
+    self.elt.send_keys(Keys.ENTER)
+    return self
+  def option(self, val):
+    self.elt.find_element_by_xpath('option[@value=%r]' % str(val)).click()
+    return self
+  def set(self, value):
+    if self.elt.is_selected() != value:
+      self.elt.click()
+    return self
+  def slow_keys(self, keys):
+    for k in keys:
+      self.send_keys(k)
+      time.sleep(.1)
+    return self
+  def wait_displayed(self, sleep=1, max=20):
+    if not fs.wait_until(self.elt.is_displayed, max, sleep):
+      raise Exception('exceeded timeout waiting for element to be displayed')
+    return self
+  def __getattr__(self, attr):
+    return getattr(self.elt, attr)
+
+class sharing(object):
+  """A browser shared by tabs: the lock held by the tab driving it."""
+  def __init__(self, wd):
+    self.wd, self.lock, self.handle = wd, threading.Lock(), None
+
+class tab(object):
+  """
+  One of several tabs of a browser, each searched in by its own thread.
+  Only the thread holding the browser (see driving) talks to it, and it
+  lets go whenever it sleeps (fs.sleep), e.g. while polling for results
+  after submitting, so one tab's wait on its airline's server overlaps the
+  others' form filling and extraction, and whichever tab's results show up
+  first are extracted first.  For that, the browser mustn't block on page
+  loads (see browser and rich_driver), or the submit would hold it until
+  the results page came in.
+  """
+  def __init__(self, shared, handle):
+    self.shared, self.handle = shared, handle
+  def acquire(self):
+    self.shared.lock.acquire()
+    if self.shared.handle != self.handle:
+      self.shared.wd.switch_to.window(self.handle)
+      self.shared.handle = self.handle
+  def idle(self, secs):
+    self.shared.lock.release()
+    try: time.sleep(secs)
+    finally: self.acquire()
+
+def tabs(wds, n):
+  """
+  n tabs in each of the browsers wds (opening any that are missing), to run
+  searches on in place of the browsers.
+  """
+  res = []
+  for wd in wds:
+    while len(wd.window_handles) < n: wd.execute_script('window.open()')
+    shared = sharing(wd)
+    res += [tab(shared, handle) for handle in wd.window_handles[:n]]
+  return res
+
+@contextlib.contextmanager
+def driving(wd, share=True):
+  """
+  Yields the browser to search with: wd itself, or if wd is a tab, its
+  browser switched to it, held until the block ends except while the
+  thread sleeps (unless not share).
+  """
+  if not isinstance(wd, tab):
+    yield wd
+    return
+  wd.acquire()
+  if share: fs.local.tab = wd
+  try: yield wd.shared.wd
+  finally:
+    fs.local.tab = None
+    wd.shared.lock.release()
+
+@contextlib.contextmanager
+def quitting(x):
+  try: yield x
+  finally: x.quit()
+
+@contextlib.contextmanager
+def subproc(*args, **kwargs):
+  p = subprocess.Popen(*args, **kwargs)
+  try: yield p
+  finally: p.terminate(); p.wait()
+
+def free_displays(n):
+  """
+  Returns n unused X display numbers; note TOCTTOU.
+  """
+  return list(itr.islice((display for display in itr.count()
+    if not path.path('/tmp/.X11-unix/X%s' % display).exists()), n))
+
+@contextlib.contextmanager
+def browser(display, debug, profile=None, blocking=True):
+  """
+  Starts an Xvfb on display and a Chrome session on top of it.  With debug,
+  Chrome runs directly on the current display instead.  profile is a
+  lean_profile to launch Chrome with, if any.  Unless blocking, commands
+  don't wait for page loads (for tabs, which shouldn't hold the browser
+  while their airline's server answers).
+  """
+  cmd = 'sleep 99999999' if debug else 'Xvfb :%s -screen 0 1600x1200x24' % display
+  with subproc(cmd.split()):
+    # Chrome (via chromedriver) inherits the display at launch, so sessions
+    # started one after another each get their own.
+    if not debug: os.environ['DISPLAY'] = ':%s' % display
+    # This silencing isn't working
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = open('/dev/null','w')
+    sys.stderr = open('/dev/null','w')
+    try:
+      wd = webdriver.Chrome(
+          chrome_options=profile.options() if profile else None,
+          desired_capabilities=None if blocking else
+              dict(webdriver.DesiredCapabilities.CHROME, pageLoadStrategy='none'))
+    finally: sys.stdout, sys.stderr = stdout, stderr
+    with quitting(wd): yield wd
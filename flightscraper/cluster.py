@@ -0,0 +1,251 @@
+"""
+Sharded runs across machines.  A coordinator (--coordinate QUEUE) plans the
+run as usual, splits the searches it has no cached results for into shards
+and puts them on a queue; workers on any number of nodes (--work QUEUE)
+claim shards, search them and put back their results, timings and
+screenshots, which the coordinator merges into the run's journal, reports
+and fare store as if it had searched them itself.
+
+A worker heartbeats each shard it holds.  If a shard's worker goes quiet for
+longer than the lease, the coordinator puts the shard back for another
+worker to claim (whichever finishes it first wins).  Past the run's
+--deadline the coordinator stops waiting, and the unfinished shards'
+searches are left out like any other skipped search.
+
+A queue is either a SQLite database (sqlite:PATH) or, given any other path,
+a spool directory.  Both need a filesystem all the nodes share, with working
+locks for SQLite.  Anything with the same methods as these two can stand in
+for them.
+"""
+
+import cPickle as pickle, contextlib, os, socket, sqlite3, threading, time, \
+    traceback, uuid, path
+import flightscraper as fs
+from . import health, planner, timing
+
+class sqlite_queue(object):
+  schema = '''
+  create table if not exists shards (
+    run text not null,
+    sid integer not null,
+    queries blob not null,
+    worker text,   -- who's searching it, if anyone
+    beat real,     -- unix time of the worker's last heartbeat
+    results blob,  -- set once done
+    primary key (run, sid)
+  );
+  '''
+  def __init__(self, db):
+    path.path(db).abspath().parent.makedirs_p()
+    self.db = db
+    with self.connect() as c: c.executescript(self.schema)
+  def connect(self):
+    # A connection per call, as the coordinator's and a worker's threads
+    # share the queue.
+    return contextlib.closing(sqlite3.connect(self.db, timeout=60,
+                                              isolation_level=None))
+  def put(self, run, sid, queries):
+    with self.connect() as c:
+      c.execute('insert into shards (run, sid, queries) values (?, ?, ?)',
+                (run, sid, sqlite3.Binary(pickle.dumps(queries, 2))))
+  def claim(self, worker):
+    """(run, shard id, queries) of a shard for worker to search, or None."""
+    with self.connect() as c:
+      c.execute('begin immediate')
+      row = c.execute('select run, sid, queries from shards where worker is '
+                      'null and results is null limit 1').fetchone()
+      if row:
+        c.execute('update shards set worker = ?, beat = ? where run = ? and sid = ?',
+                  (worker, time.time(), row[0], row[1]))
+      c.execute('commit')
+    return row and (row[0], row[1], pickle.loads(str(row[2])))
+  def beat(self, run, sid, worker):
+    """Heartbeat; False if the shard's no longer worker's."""
+    with self.connect() as c:
+      return c.execute('update shards set beat = ? where run = ? and sid = ? '
+                       'and worker = ?', (time.time(), run, sid, worker)).rowcount == 1
+  def finish(self, run, sid, results):
+    with self.connect() as c:
+      c.execute('update shards set results = ?, worker = null where run = ? '
+                'and sid = ? and results is null',
+                (sqlite3.Binary(pickle.dumps(results, 2)), run, sid))
+  def reclaim(self, lease):
+    """Puts back the shards whose workers have gone quiet; returns how many."""
+    with self.connect() as c:
+      return c.execute('update shards set worker = null, beat = null where '
+                       'worker is not null and results is null and beat < ?',
+                       (time.time() - lease,)).rowcount
+  def results(self, run, have=()):
+    """Shard id -> results of run's finished shards, except those in have."""
+    with self.connect() as c:
+      rows = c.execute('select sid, results from shards where run = ? and '
+                       'results is not null', (run,)).fetchall()
+    return dict((sid, pickle.loads(str(res))) for sid, res in rows if sid not in have)
+  def drop(self, run):
+    with self.connect() as c: c.execute('delete from shards where run = ?', (run,))
+
+class spool_queue(object):
+  """
+  Shards are files named RUN.SID: in new/ until claimed, then in
+  running/RUN.SID@WORKER (its mtime is the heartbeat), then their results in
+  done/.  Renames do the locking.
+  """
+  def __init__(self, root):
+    self.root = path.path(root)
+    for d in 'new', 'running', 'done', 'tmp': (self.root / d).makedirs_p()
+  def write(self, p, x):
+    tmp = self.root / 'tmp' / ('%s.%s' % (p.name, uuid.uuid4().hex))
+    with open(tmp, 'wb') as f: pickle.dump(x, f, 2)
+    os.rename(tmp, p)
+  def put(self, run, sid, queries):
+    self.write(self.root / 'new' / ('%s.%s' % (run, sid)), queries)
+  def claim(self, worker):
+    for p in sorted((self.root / 'new').files()):
+      claimed = self.root / 'running' / ('%s@%s' % (p.name, worker))
+      # Losing the rename race to another worker is fine; try the next one.
+      try: os.rename(p, claimed)
+      except OSError: continue
+      # The lease starts now, not when the shard was put.
+      os.utime(claimed, None)
+      run, sid = p.name.split('.')
+      with open(claimed, 'rb') as f: return run, int(sid), pickle.load(f)
+    return None
+  def beat(self, run, sid, worker):
+    try: os.utime(self.root / 'running' / ('%s.%s@%s' % (run, sid, worker)), None)
+    except OSError: return False
+    return True
+  def finish(self, run, sid, results):
+    name = '%s.%s' % (run, sid)
+    self.write(self.root / 'done' / name, results)
+    for p in (self.root / 'running').files(name + '@*'):
+      try: os.remove(p)
+      except OSError: pass
+  def reclaim(self, lease):
+    n = 0
+    for p in (self.root / 'running').files():
+      try:
+        if p.mtime >= time.time() - lease: continue
+        os.rename(p, self.root / 'new' / p.name.split('@')[0])
+      except OSError: continue
+      n += 1
+    return n
+  def results(self, run, have=()):
+    res = {}
+    for p in (self.root / 'done').files(run + '.*'):
+      sid = int(p.name.split('.')[1])
+      if sid in have: continue
+      with open(p, 'rb') as f: res[sid] = pickle.load(f)
+    return res
+  def drop(self, run):
+    for d in 'new', 'running', 'done':
+      for p in (self.root / d).files(run + '.*'):
+        try: os.remove(p)
+        except OSError: pass
+
+def open_queue(spec):
+  if spec.startswith('sqlite:'): return sqlite_queue(spec[len('sqlite:'):])
+  return spool_queue(spec)
+
+class coordinator(object):
+  """
+  Runs a run's searches on the workers of queue, in shards of up to
+  shard_size searches, reassigning shards with no heartbeat for lease
+  seconds.
+  """
+  def __init__(self, queue, shard_size=10, lease=120, poll=1):
+    self.queue, self.shard_size, self.lease, self.poll = queue, shard_size, lease, poll
+  def run(self, queries, srch, parent):
+    """
+    Like fs.searcher.run: returns (group, (label, results)) per query, and
+    hands each search's outcome, timings, waits and screenshots to srch.
+    """
+    if not queries: return []
+    run = uuid.uuid4().hex
+    nshards = (len(queries) + self.shard_size - 1) // self.shard_size
+    # Striped from the schedule rather than sliced from the plan, so each
+    # shard gets its share of the expensive searches and of the cheap ones.
+    ordered = planner.schedule(queries, health.current)
+    for sid in xrange(nshards): self.queue.put(run, sid, ordered[sid::nshards])
+    by_label = dict((q.label, q) for q in queries)
+    done = {}
+    with timing.timed('search', parent, shards=nshards) as search:
+      try:
+        finished = set()
+        while len(finished) < nshards:
+          left = health.current.remaining()
+          if left is not None and left <= 0: break
+          n = self.queue.reclaim(self.lease)
+          if n: timing.count('reassigned', n)
+          for sid, res in self.queue.results(run, finished).iteritems():
+            finished.add(sid)
+            self.merge(res, by_label, done, srch, search)
+          if len(finished) < nshards: time.sleep(self.poll)
+      finally:
+        self.queue.drop(run)
+    reported = set(done) | set(q.label for q, why in srch.missing)
+    for q in queries:
+      if q.label not in reported:
+        srch.failed(q, 'skipped: run deadline passed before its shard finished', '')
+    return [(q.group, (q.label, done.get(q.label, []))) for q in queries]
+  def merge(self, res, by_label, done, srch, search):
+    for label, r in res['done'].iteritems():
+      done[label] = r
+      srch.succeeded(by_label[label], r)
+    for label, (why, tb) in res['failed'].iteritems():
+      srch.failed(by_label[label], why, tb)
+    search.children += [timing.from_json(s) for s in res['spans']]
+    srch.waits.extend(res['waits'])
+    for name, png in res['pngs'].iteritems(): srch.shots.put(name, png)
+
+class collector(object):
+  """A worker's stand-in for the run's journal and screenshot writer."""
+  def __init__(self):
+    self.results, self.tracebacks, self.pngs = {}, {}, {}
+  def done(self, q, res): self.results[q.label] = res
+  def failed(self, q, tb): self.tracebacks[q.label] = tb
+  def put(self, name, png): self.pngs[name] = png
+
+def search_shard(wds, cfg, queries):
+  """Searches a shard's queries; returns what the coordinator merges."""
+  out = collector()
+  srch = fs.searcher(cfg, out, out)
+  root = timing.span('shard')
+  with health.installed(health.policy(cfg.health, cfg.tries)):
+    srch.run(wds, queries, root)
+  whys = dict((q.label, why) for q, why in srch.missing)
+  return dict(
+    done=out.results,
+    failed=dict((label, (whys[label], tb)) for label, tb in out.tracebacks.iteritems()),
+    spans=[s.to_json() for s in root.walk() if 'airline' in s.attrs],
+    waits=srch.waits, pngs=out.pngs)
+
+def work(cfg):
+  """Searches shards from cfg.work's queue until killed."""
+  from . import daemon
+  queue = open_queue(cfg.work)
+  worker = '%s.%s' % (socket.gethostname(), os.getpid())
+  with daemon.warm_drivers(cfg) as (wds, done_job):
+    print 'working on %s %s as %s' % (cfg.work, daemon.describe(cfg), worker)
+    while 1:
+      shard = queue.claim(worker)
+      if shard is None:
+        time.sleep(cfg.poll)
+        continue
+      run, sid, queries = shard
+      start = time.time()
+      stop = threading.Event()
+      def beat():
+        while not stop.wait(cfg.lease / 3.):
+          # Reassigned; finishing anyway is harmless, first one wins.
+          if not queue.beat(run, sid, worker): return
+      beater = threading.Thread(target=beat)
+      beater.daemon = True
+      beater.start()
+      try: queue.finish(run, sid, search_shard(wds(), cfg, queries))
+      except Exception:
+        # Left for the coordinator to reassign once the lease runs out.
+        traceback.print_exc()
+      finally: stop.set()
+      print 'shard %s.%s: %s searches in %.1fs' % (run, sid, len(queries),
+                                                   time.time() - start)
+      done_job()
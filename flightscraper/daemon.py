@@ -0,0 +1,155 @@
+"""
+Long-running mode: keeps browser sessions warm and runs query jobs dropped
+into a spool directory, so an ad-hoc search costs a page load rather than an
+Xvfb and Chrome start.
+
+The spool has these subdirectories:
+
+  new/      jobs to run: query specs (see flightscraper.planner), optionally
+            with a "mailto" key to mail the results to (whether or not
+            any fares changed); run in name order
+  running/  the jobs being run, in a HOST@PID subdirectory per daemon
+  done/     finished jobs
+  failed/   jobs that raised, each next to a NAME.err with the traceback
+  out/NAME/ each job's results.pickle, reports and screenshots
+"""
+
+import contextlib, copy, datetime as dt, errno, json, os, socket, time, \
+    traceback, path
+import flightscraper as fs
+
+class warm_browser(object):
+  """
+  A browser session kept across jobs.  It's restarted after max_jobs jobs,
+  or as soon as it stops responding.
+  """
+  def __init__(self, debug, max_jobs, profile=None, blocking=True):
+    self.debug, self.max_jobs, self.profile = debug, max_jobs, profile
+    self.blocking = blocking
+    self.session = self.wd = None
+  def start(self):
+    from . import chrome
+    [display] = chrome.free_displays(1)
+    self.session = chrome.browser(display, self.debug, self.profile, self.blocking)
+    self.wd = self.session.__enter__()
+    self.jobs = 0
+  def stop(self):
+    if self.session is None: return
+    try: self.session.__exit__(None, None, None)
+    except Exception: pass
+    self.session = self.wd = None
+  def alive(self):
+    try:
+      self.wd.current_url
+      return True
+    except Exception:
+      return False
+  def done_job(self):
+    self.jobs += 1
+    if self.jobs >= self.max_jobs or not self.alive():
+      self.stop()
+      self.start()
+
+def claim(spool, owner):
+  """
+  Moves the first job in new/ to owner's directory in running/ and returns
+  its new path, or None if there are none.
+  """
+  for p in sorted((spool / 'new').files('*.json')):
+    claimed = spool / 'running' / owner / p.name
+    # Losing the rename race to another daemon is fine; try the next job.
+    try: os.rename(p, claimed)
+    except OSError: continue
+    return claimed
+  return None
+
+def run_job(job, wds, cfg, spool):
+  name = job.namebase
+  jcfg = copy.copy(cfg)
+  jcfg.outdir = spool / 'out' / name
+  jcfg.outdir.mkdir_p()
+  jcfg.test = False
+  jcfg.now = dt.datetime.now()
+  try:
+    with open(job) as f: spec = json.load(f)
+    jcfg.routes = fs.planner.parse_spec(spec)
+    jcfg.mailto = spec.get('mailto')
+    # A job's mailto asked for its results, changed or not.
+    jcfg.mail_always = cfg.mail_always or bool(jcfg.mailto)
+    email_text, email_html, by_route, changes = fs.script(wds, jcfg)
+    fs.save_results(jcfg, email_text, email_html, by_route)
+    with contextlib.closing(fs.alerts.mailer(cfg.smtp)) as mailer:
+      fs.notify(jcfg, email_text, email_html, changes, mailer)
+  except Exception:
+    with open(spool / 'failed' / name + '.err', 'w') as f:
+      f.write(traceback.format_exc())
+    os.rename(job, spool / 'failed' / job.name)
+    return False
+  os.rename(job, spool / 'done' / job.name)
+  return True
+
+def alive(pid):
+  try: os.kill(pid, 0)
+  except OSError as ex: return ex.errno != errno.ESRCH
+  return True
+
+def requeue_dead(spool):
+  """
+  Puts the jobs of daemons on this host that died while running them back
+  in new/.  Other hosts' daemons can't be checked from here, so their jobs
+  are left to them (or to a daemon started on their host).
+  """
+  host = socket.gethostname()
+  for d in (spool / 'running').dirs():
+    owner_host, _, pid = d.name.rpartition('@')
+    if owner_host != host or not pid.isdigit() or alive(int(pid)): continue
+    for p in d.files('*.json'): os.rename(p, spool / 'new' / p.name)
+    try: d.rmdir()
+    except OSError: pass
+
+def serve(cfg):
+  spool = path.path(cfg.daemon)
+  for d in 'new', 'running', 'done', 'failed', 'out': (spool / d).makedirs_p()
+  owner = '%s@%s' % (socket.gethostname(), os.getpid())
+  requeue_dead(spool)
+  (spool / 'running' / owner).mkdir_p()
+
+  def loop(wds, done_job=lambda: None):
+    while 1:
+      job = claim(spool, owner)
+      if job is None:
+        time.sleep(cfg.poll)
+        continue
+      start = time.time()
+      ok = run_job(job, wds(), cfg, spool)
+      print '%s %s in %.1fs' % (job.namebase, 'done' if ok else 'failed',
+                                time.time() - start)
+      done_job()
+
+  with warm_drivers(cfg) as (wds, done_job):
+    print 'serving %s %s' % (spool, describe(cfg))
+    loop(wds, done_job)
+
+def describe(cfg):
+  return 'over http' if cfg.engine == 'http' else \
+         'with %s warm browser(s)' % cfg.workers
+
+@contextlib.contextmanager
+def warm_drivers(cfg):
+  """
+  Yields (a function returning the drivers for the next job, a function to
+  call after each job): http sessions, or cfg.workers warm browsers.
+  """
+  if cfg.engine == 'http':
+    with fs.http_sessions(cfg) as ss:
+      yield lambda: ss, lambda: None
+    return
+  workers = [warm_browser(cfg.debug, cfg.recycle, cfg.page_profile, cfg.tabs == 1)
+             for _ in xrange(cfg.workers)]
+  def recycle():
+    for w in workers: w.done_job()
+  try:
+    for w in workers: w.start()
+    yield lambda: [w.wd for w in workers], recycle
+  finally:
+    for w in workers: w.stop()
@@ -0,0 +1,272 @@
+"""
+Local stand-ins for the airline sites, for benchmarking and testing the
+scrapers offline.  Each site's search page has the element IDs, names and
+form shapes the airline functions (both the browser and the http engine's)
+fill in, and its results page the classes they read prices off.  Prices are
+made up, but stable for a given airline, route and day.
+
+Sites are served under /AIRLINE/ (see site_urls), and requests for the real
+sites' URLs are answered too, so the server also works as the http engine's
+--proxy.  Every response can be delayed, and a fraction of results pages
+fail with a 503, to exercise the retry paths.
+"""
+
+import BaseHTTPServer, SocketServer, argparse, calendar, cgi, datetime as dt, \
+    hashlib, random, threading, time, urlparse
+import flightscraper as fs
+
+airports = 'sfo sjc oak phl ewr jfk lga bos lax sea ord iad dca'.split()
+
+def fare(airline, org, dst, date):
+  """A made-up price for the day, the same every time it's asked for."""
+  h = hashlib.sha1('%s %s %s %s' % (airline, org.lower(), dst.lower(), date))
+  return 150 + int(h.hexdigest()[:6], 16) % 300
+
+def options(values, labels=None):
+  return ''.join('<option value="%s">%s</option>' % (v, l) for v, l in
+                 zip(values, labels or values))
+
+def page(body, title='Search'):
+  return '<!DOCTYPE html><html><head><title>%s</title></head><body>%s</body></html>' \
+         % (title, body)
+
+def months_around(date, n=24):
+  """The first days of the n months either side of date's."""
+  month = date.year * 12 + date.month - 1
+  return [dt.date(m // 12, m % 12 + 1, 1) for m in xrange(month - n, month + n + 1)]
+
+def around(date, days=3):
+  return [date + dt.timedelta(days=n) for n in xrange(-days, days + 1)]
+
+def month_days(month):
+  return [month.replace(day=d)
+          for d in xrange(1, calendar.monthrange(month.year, month.month)[1] + 1)]
+
+def parse_mdy(s):
+  m, d, y = map(int, s.split('/'))
+  return dt.date(y, m, d)
+
+# Search pages.  Field names are the IDs, so both engines submit the same
+# parameters.
+
+def text(id, value=''):
+  return '<input type="text" id="%s" name="%s" value="%s">' % (id, id, value)
+
+def checkbox(id, checked=False):
+  return '<input type="checkbox" id="%s" name="%s" value="on"%s>' % (
+      id, id, ' checked' if checked else '')
+
+def radio(id, name, value, checked=False):
+  return '<input type="radio" id="%s" name="%s" value="%s"%s>' % (
+      id, name, value, ' checked' if checked else '')
+
+def select(id, opts, name=None):
+  return '<select id="%s" name="%s">%s</select>' % (id, name or id, opts)
+
+def submit(id, cls=''):
+  return '<input type="submit" id="%s" name="%s" class="%s" value="Search">' % (
+      id, id, cls)
+
+def form(airline, body, id=''):
+  return '<form id="%s" method="get" action="/%s/results">%s</form>' % (
+      id, airline, body)
+
+united_pre = 'ctl00_ContentInfo_Booking1_'
+months = months_around(dt.date.today())
+search_pages = dict(
+  united=form('united', ''.join([
+    radio(united_pre + 'rdoSearchType1', 'searchType', 'rt', True),
+    radio(united_pre + 'rdoSearchType2', 'searchType', 'ow'),
+    text(united_pre + 'Origin_txtOrigin'),
+    text(united_pre + 'Destination_txtDestination'),
+    checkbox(united_pre + 'Nearbyair_chkFltOpt'),
+    checkbox(united_pre + 'AltDate_chkFltOpt'),
+    radio(united_pre + 'DepDateTime_rdoDateSpecific', 'dateType', 'specific', True),
+    radio(united_pre + 'DepDateTime_rdoDateFlex', 'dateType', 'flex'),
+    select(united_pre + 'DepDateTime_MonthList1_cboMonth',
+           options([fs.fmt_date(m, True) for m in months])),
+    submit(united_pre + 'btnSearchFlight')])),
+  aa=form('aa', ''.join([
+    text('flightSearchForm.originAirport'),
+    text('flightSearchForm.destinationAirport'),
+    select('flightSearchForm.originAlternateAirportDistance', options([0, 30, 60, 90])),
+    select('flightSearchForm.destinationAlternateAirportDistance', options([0, 30, 60, 90])),
+    radio('flightSearchForm.searchType.fare', 'searchType', 'fare', True),
+    radio('flightSearchForm.searchType.matrix', 'searchType', 'matrix'),
+    select('flightSearchForm.flightParams.flightDateParams.travelMonth',
+           options(range(1, 13))),
+    select('flightSearchForm.flightParams.flightDateParams.travelDay',
+           options(range(1, 32))),
+    select('flightSearchForm.flightParams.flightDateParams.searchTime',
+           options([120001, 40001])),
+    checkbox('flightSearchForm.carrierAll')]), id='flightSearchForm'),
+  virginamerica=form('virginamerica', ''.join([
+    radio('rtRadio', 'tripType', 'rt', True),
+    radio('owRadio', 'tripType', 'ow'),
+    select('origin', options([a.upper() for a in airports]), 'flightSearch.origin'),
+    select('destination', options([a.upper() for a in airports]),
+           'flightSearch.destination'),
+    '<input type="text" name="flightSearch.depDate.MMDDYYYY" value="">',
+    submit('SearchFlightBt')])),
+  bing=form('bing', ''.join([
+    radio('roundTrip', 'tripType', 'rt', True),
+    '<label id="oneWayLabel" for="oneWay">One way</label>',
+    radio('oneWay', 'tripType', 'ow'),
+    text('orig1Text'), checkbox('no1'),
+    text('dest1Text'), checkbox('ne1'),
+    text('leave1'),
+    checkbox('PRI-HP', True),
+    submit('go', 'sbmtBtn')])),
+  southwest=form('southwest', ''.join([
+    radio('roundTrip', 'tripType', 'rt', True),
+    radio('oneWay', 'tripType', 'ow'),
+    text('originAirport_displayed'),
+    text('destinationAirport_displayed'),
+    select('outboundDate', options([fs.fmt_date(m) for m in months])),
+    submit('submitButton')])),
+  delta=form('delta', ''.join([
+    '<a id="oneway_link" href="#">One way</a>',
+    text('departureCity_0'),
+    text('destinationCity_0'),
+    checkbox('flexAirports'),
+    text('departureDate_0'),
+    submit('Go')])),
+)
+
+# Results pages, from the submitted form's parameters.
+
+def united_results(q):
+  org = q[united_pre + 'Origin_txtOrigin']
+  dst = q[united_pre + 'Destination_txtDestination']
+  month = parse_mdy(q[united_pre + 'DepDateTime_MonthList1_cboMonth'])
+  return '<table><tr>%s</tr></table>' % ''.join(
+      '<td class="on"><div>%s</div><div>Lowest</div><div>$%s</div></td>'
+      % (d.strftime('%a, %b %d'), fare('united', org, dst, d))
+      for d in month_days(month))
+
+def aa_results(q):
+  f = 'flightSearchForm.'
+  org, dst = q[f + 'originAirport'], q[f + 'destinationAirport']
+  month = int(q[f + 'flightParams.flightDateParams.travelMonth'])
+  day = int(q[f + 'flightParams.flightDateParams.travelDay'])
+  date = dt.date(fs.infer_year(month, day, dt.date.today()), month, day)
+  return ''.join('<div class="%s">%s from $%s</div>' % (
+                   'highlightSubHeader' if d == date else 'tabNotActive',
+                   d.strftime('%a %b %d'), fare('aa', org, dst, d))
+                 for d in around(date))
+
+def virginamerica_results(q):
+  org, dst = q['flightSearch.origin'], q['flightSearch.destination']
+  date = parse_mdy(q['flightSearch.depDate.MMDDYYYY'])
+  return ''.join('<li><span class="fsCarouselDate">%s</span>'
+                 '<span class="fsCarouselCost">$%s</span></li>'
+                 % (d.strftime('%a %b %d'), fare('virginamerica', org, dst, d))
+                 for d in around(date))
+
+def bing_results(q):
+  date = parse_mdy(q['leave1'])
+  return '<div id="searching" style="display: none">Still searching...</div>' \
+         '<span class="price">$%s</span>' % fare('bing', q['orig1Text'], q['dest1Text'], date)
+
+def southwest_results(q):
+  org, dst = q['originAirport_displayed'], q['destinationAirport_displayed']
+  month = parse_mdy(q['outboundDate'])
+  return ('<div class="carouselTodaySodaIneligible"><div class="carouselBody">%s</div></div>'
+          % month.strftime('%B %Y')) + \
+         ''.join('<div class="fareAvailableDay"><div>%s</div><div>$%s</div></div>'
+                 % (d.day, fare('southwest', org, dst, d)) for d in month_days(month))
+
+def delta_results(q):
+  date = parse_mdy(q['departureDate_0'])
+  return '<div class="lowest"><span class="fares">$%s</span></div>' % fare(
+      'delta', q['departureCity_0'], q['destinationCity_0'], date)
+
+results_pages = dict(united=united_results, aa=aa_results,
+                     virginamerica=virginamerica_results, bing=bing_results,
+                     southwest=southwest_results, delta=delta_results)
+
+class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Send headers and body in one write (flushed after each request); as
+  # separate small writes, Nagle and delayed ACKs add ~40ms per response.
+  wbufsize = -1
+  def airline_and_path(self):
+    """
+    The site asked for, from the path's first component or, for proxied
+    requests of the real sites' URLs, the host.
+    """
+    _, host, p, query, _ = urlparse.urlsplit(self.path)
+    first, _, rest = p.lstrip('/').partition('/')
+    if first in search_pages: return first, rest, query
+    host = host or self.headers.getheader('host', '')
+    for airline, url in fs.urls.iteritems():
+      if urlparse.urlsplit(url).netloc == host:
+        return airline, 'results' if p.endswith('/results') else '', query
+    return None, p, query
+  def do_GET(self):
+    srv = self.server
+    with srv.lock:
+      srv.requests += 1
+      delay = max(0, srv.rng.gauss(srv.latency, srv.jitter))
+      fail = srv.rng.random() < srv.fail_rate
+    time.sleep(delay)
+    airline, rest, query = self.airline_and_path()
+    if airline is None: return self.reply(404, page('No such site', 'Not found'))
+    if rest != 'results': return self.reply(200, page(search_pages[airline]))
+    if fail:
+      with srv.lock: srv.failures += 1
+      return self.reply(503, page('Please try again later', 'Unavailable'))
+    q = dict((k, v[-1]) for k, v in cgi.parse_qs(query).iteritems())
+    try: body = results_pages[airline](q)
+    except (KeyError, ValueError) as ex:
+      return self.reply(400, page('Bad search: %s' % ex, 'Bad request'))
+    self.reply(200, page(body, 'Results'))
+  def reply(self, status, body):
+    self.send_response(status)
+    self.send_header('Content-Type', 'text/html; charset=utf-8')
+    self.send_header('Content-Length', len(body))
+    self.end_headers()
+    self.wfile.write(body)
+  def log_message(self, *args): pass
+
+class server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """
+  The fake sites on 127.0.0.1:port (0 picks a free one).  Each request is
+  delayed by a normally distributed latency (seconds), and each results page
+  fails with probability fail_rate.
+  """
+  daemon_threads = True
+  def __init__(self, port=0, latency=0, jitter=0, fail_rate=0, seed=0):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), handler)
+    self.latency, self.jitter, self.fail_rate = latency, jitter, fail_rate
+    self.rng = random.Random(seed)
+    self.lock = threading.Lock()
+    self.requests = self.failures = 0
+  def start(self):
+    """Serves from a background thread; returns self."""
+    t = threading.Thread(target=self.serve_forever)
+    t.daemon = True
+    t.start()
+    return self
+  def site_urls(self):
+    """What fs.urls should be for the airline functions to use these sites."""
+    return dict((airline, 'http://127.0.0.1:%s/%s/' % (self.server_port, airline))
+                for airline in search_pages)
+
+def main(argv=None):
+  p = argparse.ArgumentParser(description='Serve fake airline sites locally.')
+  p.add_argument('-p', '--port', type=int, default=8080)
+  p.add_argument('--latency', type=float, default=0,
+      help='Mean delay per request, in milliseconds.')
+  p.add_argument('--jitter', type=float, default=0,
+      help='Standard deviation of the delay, in milliseconds.')
+  p.add_argument('--fail-rate', type=float, default=0,
+      help='Fraction of results pages answered with a 503.')
+  p.add_argument('--seed', type=int, default=0)
+  cfg = p.parse_args(argv)
+  s = server(cfg.port, cfg.latency / 1000., cfg.jitter / 1000., cfg.fail_rate, cfg.seed)
+  print 'serving fake sites on 127.0.0.1:%s (use as --proxy with -e http)' % s.server_port
+  for airline, url in sorted(s.site_urls().iteritems()): print '  %s' % url
+  s.serve_forever()
+
+if __name__ == '__main__': main()
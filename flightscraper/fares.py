@@ -0,0 +1,93 @@
+"""
+Compact in-memory table of a run's fares, for aggregating them into reports.
+
+Group and label names are interned to small ids, and each fare is one row
+across typed arrays of price, travel date, group id and label id, rather than
+an object per fare.  The aggregates the reports need (per travel date: the
+rows, the cheapest price and which groups have a price) are kept up to date
+as fares are added, so nothing rescans the rows.
+"""
+
+import array, bisect, datetime as dt
+
+class resinfo(object):
+  """One fare as the reports list it."""
+  __slots__ = 'prc', 'group', 'label'
+  def __init__(self, prc, group, label):
+    self.prc, self.group, self.label = prc, group, label
+
+def month_range(month):
+  """The ordinals of the first day of month (a date in it) and of the next."""
+  first = month.replace(day=1)
+  return first.toordinal(), (first + dt.timedelta(days=32)).replace(day=1).toordinal()
+
+def intern(names, ids, name):
+  i = ids.get(name)
+  if i is None:
+    i = ids[name] = len(names)
+    names.append(name)
+  return i
+
+class fare_table(object):
+  """
+  The fares of raw_res (as built by script()), plus any added later.  Only
+  groups and labels with a fare are interned, except for groups added with
+  group_id, e.g. those of failed searches.
+  """
+  def __init__(self, raw_res=()):
+    self.groups, self.group_ids = [], {}
+    self.labels, self.label_ids = [], {}
+    self.prcs, self.days, self.gids, self.lids = [array.array('l') for _ in xrange(4)]
+    # Keyed by travel date (as an ordinal): row numbers in the order added,
+    # cheapest price, and a bitmask of the group ids with a price.
+    self.rows_on, self.best_on, self.groups_on = {}, {}, {}
+    for group, (label, res) in raw_res: self.add(group, label, res)
+  def group_id(self, group): return intern(self.groups, self.group_ids, group)
+  def add(self, group, label, res):
+    """Adds search label's (price, date) results, for group."""
+    if not res: return
+    gid = self.group_id(group)
+    lid = intern(self.labels, self.label_ids, label)
+    rows_on, best_on, groups_on = self.rows_on, self.best_on, self.groups_on
+    bit = 1 << gid
+    row = len(self.prcs)
+    for prc, date in res:
+      day = date.toordinal()
+      self.prcs.append(prc)
+      self.days.append(day)
+      rows = rows_on.get(day)
+      if rows is None:
+        rows = rows_on[day] = array.array('l')
+        best_on[day], groups_on[day] = prc, bit
+      else:
+        if prc < best_on[day]: best_on[day] = prc
+        groups_on[day] |= bit
+      rows.append(row)
+      row += 1
+    n = len(res)
+    self.gids.extend(array.array('l', [gid]) * n)
+    self.lids.extend(array.array('l', [lid]) * n)
+  def __len__(self): return len(self.prcs)
+  def ngroups(self): return len(self.groups)
+  def best(self, date):
+    """The cheapest price on date, or None."""
+    return self.best_on.get(date.toordinal())
+  def ngroups_on(self, date):
+    """How many groups have a price on date."""
+    return bin(self.groups_on.get(date.toordinal(), 0)).count('1')
+  def info(self, row):
+    return resinfo(self.prcs[row], self.groups[self.gids[row]],
+                   self.labels[self.lids[row]])
+  def travel_days(self, month=None):
+    """The travel dates (as ordinals) with fares, in order; just month's if given."""
+    days = sorted(self.rows_on)
+    if month is None: return days
+    start, end = month_range(month)
+    return days[bisect.bisect_left(days, start):bisect.bisect_left(days, end)]
+  def by_date(self, month=None):
+    """(date, [resinfo]) per travel date with fares, in date order."""
+    for day in self.travel_days(month):
+      yield dt.date.fromordinal(day), [self.info(r) for r in self.rows_on[day]]
+  def best_in(self, month):
+    """The cheapest price in month, or None."""
+    return min([self.best_on[day] for day in self.travel_days(month)] or [None])
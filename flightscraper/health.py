@@ -0,0 +1,151 @@
+"""
+Per-airline health across runs, and the retry policy built on it.
+
+Each airline's searches feed a success rate and a latency (both moving
+averages) and a count of consecutive failed searches, kept in a small JSON
+file between runs.  After threshold consecutive failures the airline's
+circuit breaker opens and its searches are skipped for a cooldown, which
+doubles (up to max_cooldown) each time a trial search after it fails again.
+
+Successful browser searches also keep, per page-load mode ('full' or 'lean'),
+moving averages of the bytes their pages transferred and their navigate time,
+so a lean search can be compared with what the same search costs in full.
+
+Within a run, a search is retried with exponential backoff and full jitter,
+and nothing is started (or waited on) past the run's deadline, if any.
+"""
+
+import contextlib, datetime as dt, json, os, random, threading, time, traceback
+import flightscraper as fs
+from . import timing
+
+class skipped(Exception):
+  """A search not run: its airline's breaker is open or time's up."""
+
+class airline_health(object):
+  fields = 'rate latency searches consecutive open_until cooldown pages'.split()
+  def __init__(self, rate=1., latency=None, searches=0, consecutive=0,
+               open_until=0, cooldown=0, pages=None):
+    self.rate, self.latency, self.searches = rate, latency, searches
+    self.consecutive, self.open_until, self.cooldown = consecutive, open_until, cooldown
+    # mode -> [bytes, navigate seconds]
+    self.pages = pages or {}
+  def to_json(self): return dict((k, getattr(self, k)) for k in self.fields)
+
+class policy(object):
+  """
+  Retry policy and breakers for one run.  state is the JSON file the
+  airlines' health is kept in (None to keep it in memory only).  deadline is
+  the run's budget in seconds, from now.
+  """
+  def __init__(self, state=None, tries=3, base=1., cap=30., deadline=None,
+               threshold=3, cooldown=3600, max_cooldown=86400, alpha=.2,
+               rng=None):
+    self.state, self.tries, self.base, self.cap = state, tries, base, cap
+    self.deadline = time.time() + deadline if deadline else None
+    self.threshold, self.cooldown, self.max_cooldown = threshold, cooldown, max_cooldown
+    self.alpha = alpha
+    self.rng = rng or random.Random()
+    self.lock = threading.Lock()
+    self.airlines = {}
+    if state and os.path.exists(state):
+      with open(state) as f:
+        for airline, d in json.load(f).iteritems():
+          self.airlines[airline] = airline_health(**d)
+  def health(self, airline):
+    return self.airlines.setdefault(airline, airline_health())
+  def remaining(self):
+    """Seconds left of the run's budget, or None if it has none."""
+    return None if self.deadline is None else self.deadline - time.time()
+  def wait_budget(self, maxsec):
+    """How long an element wait may take: maxsec, or less near the deadline."""
+    left = self.remaining()
+    return maxsec if left is None else max(0, min(maxsec, left))
+  def delay(self, attempt):
+    """Full jitter: uniform up to the exponential backoff for attempt."""
+    return self.rng.uniform(0, min(self.cap, self.base * 2 ** attempt))
+  def check(self, airline):
+    """Raises skipped if airline's searches shouldn't be run now."""
+    h = self.health(airline)
+    now = time.time()
+    if h.open_until > now:
+      raise skipped('circuit open until %s after %s failed searches' % (
+          dt.datetime.fromtimestamp(h.open_until).strftime('%H:%M'), h.consecutive))
+    left = self.remaining()
+    if left is None: return
+    if left <= 0: raise skipped('run deadline passed')
+    if left < (h.latency or 0):
+      raise skipped('run deadline: %.0fs left, searches take ~%.0fs' % (
+          left, h.latency))
+  def record(self, airline, ok, secs):
+    with self.lock:
+      h = self.health(airline)
+      h.searches += 1
+      h.rate += self.alpha * ((1. if ok else 0.) - h.rate)
+      if ok:
+        h.latency = secs if h.latency is None else h.latency + self.alpha * (secs - h.latency)
+        h.consecutive = h.cooldown = 0
+        return
+      h.consecutive += 1
+      if h.consecutive >= self.threshold:
+        # Past the threshold, every failure (i.e. each failed trial after a
+        # cooldown) reopens the breaker for twice as long.
+        h.cooldown = min(self.max_cooldown, 2 * h.cooldown or self.cooldown)
+        h.open_until = time.time() + h.cooldown
+  def record_pages(self, airline, mode, nbytes, secs):
+    with self.lock:
+      avg = self.health(airline).pages.get(mode)
+      if avg is None: self.health(airline).pages[mode] = [nbytes, secs]
+      else:
+        avg[0] += self.alpha * (nbytes - avg[0])
+        avg[1] += self.alpha * (secs - avg[1])
+  def page_baselines(self, mode='full'):
+    """airline -> (bytes, navigate seconds) of its searches in mode."""
+    with self.lock:
+      return dict((a, tuple(h.pages[mode])) for a, h in self.airlines.iteritems()
+                  if mode in h.pages)
+  def call(self, airline, f):
+    """
+    Runs f (a search of airline), retrying failures with backoff while tries
+    and the deadline allow.  Raises skipped instead of starting if the
+    airline's breaker is open or the deadline has passed.
+    """
+    self.check(airline)
+    start = time.time()
+    for attempt in xrange(self.tries):
+      try:
+        res = f()
+      except Exception:
+        timing.count('errors')
+        pause = self.delay(attempt)
+        left = self.remaining()
+        if attempt == self.tries - 1 or left is not None and left < pause:
+          self.record(airline, False, time.time() - start)
+          raise
+        timing.count('retries')
+        print traceback.format_exc()
+        fs.sleep(pause)
+      else:
+        self.record(airline, True, time.time() - start)
+        return res
+  def save(self):
+    if not self.state: return
+    with self.lock:
+      data = dict((a, h.to_json()) for a, h in self.airlines.iteritems())
+    tmp = '%s.%s.tmp' % (self.state, os.getpid())
+    with open(tmp, 'w') as f: json.dump(data, f, indent=1, sort_keys=True)
+    os.rename(tmp, self.state)
+
+# The policy airline functions retry under (see fs.retry_if_timeout); script()
+# installs one per run.
+current = policy()
+
+@contextlib.contextmanager
+def installed(p):
+  """Makes p the current policy within the block, and saves it after."""
+  global current
+  prior, current = current, p
+  try: yield p
+  finally:
+    current = prior
+    p.save()
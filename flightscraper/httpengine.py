@@ -0,0 +1,336 @@
+"""
+Browserless engine: runs the same searches as the browser-driven airline
+functions with plain HTTP requests over pooled keep-alive connections, parsing
+the responses with lxml.  Sessions can record every response to a fixture
+directory and replay them from there, either directly or through a local
+stand-in server, so the engine can be tested and benchmarked offline.
+
+Each search is a GET of the airline's search page followed by a submit of its
+form, filled in through the same element IDs the browser functions use.
+Anything the sites only render with JavaScript (e.g. bing's progressive
+results) isn't available here.
+"""
+
+import BaseHTTPServer, Cookie, SocketServer, argparse, hashlib, httplib, \
+    json, socket, urllib, urlparse, zlib, path
+import lxml.html, lxml.cssselect
+import flightscraper as fs
+from . import timing
+
+class response(object):
+  def __init__(self, url, status, headers, body):
+    self.url, self.status, self.headers, self.body = url, status, headers, body
+  @property
+  def doc(self):
+    if not hasattr(self, '_doc'):
+      self._doc = lxml.html.fromstring(self.body, base_url=self.url)
+    return self._doc
+
+def fixture_key(method, url, body):
+  return hashlib.sha1('%s %s\n%s' % (method, url, body or '')).hexdigest()
+
+def save_fixture(fixtures, method, url, body, resp):
+  key = fixture_key(method, url, body)
+  with open(fixtures / key + '.body', 'wb') as f: f.write(resp.body)
+  with open(fixtures / key + '.json', 'w') as f:
+    json.dump(dict(method=method, url=url, body=body, status=resp.status,
+                   headers=resp.headers, final_url=resp.url), f, indent=2)
+
+def load_fixture(fixtures, method, url, body):
+  key = fixture_key(method, url, body)
+  try:
+    with open(fixtures / key + '.json') as f: meta = json.load(f)
+    with open(fixtures / key + '.body', 'rb') as f: data = f.read()
+  except IOError:
+    raise KeyError('no fixture for %s %s' % (method, url))
+  return response(meta['final_url'], meta['status'], meta['headers'], data)
+
+class server_error(Exception): pass
+
+class session(object):
+  """
+  A cookie-keeping HTTP client that holds one keep-alive connection per host
+  (or a single one to proxy, if given, sending it absolute URLs).  mode is
+  'live', 'record' (live, saving every response under fixtures) or 'replay'
+  (answering only from fixtures, without touching the network).  Not
+  thread-safe; use one session per worker.  Server errors (5xx) raise
+  server_error, which the airline functions retry like the browser ones.
+  """
+  debug = False # for fs.retry_if_timeout
+  def __init__(self, mode='live', fixtures=None, proxy=None, timeout=60):
+    self.mode, self.proxy, self.timeout = mode, proxy, timeout
+    self.fixtures = path.path(fixtures) if fixtures else None
+    if mode == 'record': self.fixtures.mkdir_p()
+    self.conns = {}
+    self.cookies = {}
+  def close(self):
+    for conn in self.conns.itervalues(): conn.close()
+    self.conns.clear()
+  def conn(self, scheme, host):
+    key = self.proxy or (scheme, host)
+    if key not in self.conns:
+      cls = httplib.HTTPSConnection if scheme == 'https' and not self.proxy \
+            else httplib.HTTPConnection
+      self.conns[key] = cls(self.proxy or host, timeout=self.timeout)
+    return self.conns[key]
+  def request(self, method, url, body=None, redirects=5):
+    if self.mode == 'replay':
+      resp = load_fixture(self.fixtures, method, url, body)
+    else:
+      resp = self.fetch(method, url, body)
+      if self.mode == 'record':
+        save_fixture(self.fixtures, method, url, body, resp)
+    if resp.status in (301, 302, 303, 307) and redirects:
+      location = urlparse.urljoin(url, resp.headers['location'])
+      if resp.status == 307: return self.request(method, location, body, redirects - 1)
+      return self.request('GET', location, None, redirects - 1)
+    if resp.status >= 500:
+      raise server_error('%s from %s' % (resp.status, urlparse.urlsplit(url).netloc))
+    return resp
+  def fetch(self, method, url, body):
+    scheme, host, path_, query, _ = urlparse.urlsplit(url)
+    target = url if self.proxy else urlparse.urlunsplit(('', '', path_ or '/', query, ''))
+    headers = {'Accept-Encoding': 'gzip', 'Host': host,
+               'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) Chrome/23.0'}
+    cookies = self.cookies.get(host)
+    if cookies:
+      headers['Cookie'] = '; '.join('%s=%s' % kv for kv in cookies.iteritems())
+    if body is not None:
+      headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    # A kept-alive connection the server has since dropped fails on first
+    # use; retry once on a fresh one.
+    for trial in xrange(2):
+      conn = self.conn(scheme, host)
+      try:
+        conn.request(method, target, body, headers)
+        r = conn.getresponse()
+        data = r.read()
+        break
+      except (httplib.HTTPException, socket.error):
+        conn.close()
+        del self.conns[self.proxy or (scheme, host)]
+        if trial: raise
+    # Per search, in profile.json alongside the browser's page_bytes.
+    timing.count('requests')
+    if r.getheader('content-encoding') == 'gzip':
+      data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    for header in r.msg.getallmatchingheaders('set-cookie'):
+      c = Cookie.SimpleCookie(header.split(':', 1)[1].strip())
+      self.cookies.setdefault(host, {}).update(
+          (k, m.value) for k, m in c.iteritems())
+    headers = dict((k, v) for k, v in r.getheaders()
+                   if k not in ('content-encoding', 'content-length',
+                                'transfer-encoding', 'connection'))
+    return response(url, r.status, headers, data)
+  def get(self, url):
+    timing.phase('navigate')
+    try: return self.request('GET', url)
+    finally: timing.phase('fill')
+  def submit(self, form, values={}, submit=None):
+    """
+    Submits lxml form with its current values, overridden by values (a dict
+    keyed by field name), and the named submit button if any.
+    """
+    fields = dict(form.form_values())
+    fields.update(values)
+    if submit is not None:
+      btn = form.get_element_by_id(submit)
+      if btn.name: fields[btn.name] = btn.get('value', '')
+    data = urllib.urlencode(sorted(fields.items()))
+    timing.phase('submit')
+    try:
+      if form.method == 'POST': return self.request('POST', form.action, data)
+      return self.request('GET', '%s?%s' % (form.action.split('?')[0], data))
+    finally: timing.phase('extract')
+
+# Page helpers, mirroring rich_driver/rich_web_elt on parsed documents.
+
+def byid(doc, x): return doc.get_element_by_id(x)
+
+def form_of(doc, x):
+  """The form containing the element with id x (or that is it)."""
+  elt = byid(doc, x)
+  while elt is not None and elt.tag != 'form': elt = elt.getparent()
+  return elt
+
+def check(doc, x, value=True):
+  """Checks the checkbox/radio with id x, or the one labelled by it."""
+  elt = byid(doc, x)
+  if elt.tag == 'label': elt = elt.for_element
+  elt.checked = value
+
+def select(doc, x, value):
+  byid(doc, x).value = str(value)
+
+def setval(doc, x, value):
+  byid(doc, x).value = value
+
+def lines(elt):
+  """The element's non-blank text chunks, roughly its rendered lines."""
+  return [t.strip() for t in elt.itertext() if t.strip()]
+
+def css(doc, x): return lxml.cssselect.CSSSelector(x)(doc)
+
+@fs.retry_if_timeout
+def united(s, org, dst, date, nearby=False):
+  """
+  Returns list of (best price, day) pairs for month around date.
+  """
+  doc = s.get(fs.urls['united']).doc
+  check(doc, 'ctl00_ContentInfo_Booking1_rdoSearchType2')
+  setval(doc, 'ctl00_ContentInfo_Booking1_Origin_txtOrigin', org)
+  setval(doc, 'ctl00_ContentInfo_Booking1_Destination_txtDestination', dst)
+  if nearby: check(doc, 'ctl00_ContentInfo_Booking1_Nearbyair_chkFltOpt')
+  check(doc, 'ctl00_ContentInfo_Booking1_AltDate_chkFltOpt')
+  check(doc, 'ctl00_ContentInfo_Booking1_DepDateTime_rdoDateFlex')
+  select(doc, 'ctl00_ContentInfo_Booking1_DepDateTime_MonthList1_cboMonth',
+         fs.fmt_date(fs.month_of(date), True))
+  btn = 'ctl00_ContentInfo_Booking1_btnSearchFlight'
+  res = s.submit(form_of(doc, btn), submit=btn).doc
+  return [(fs.toprc(ls[-1]), fs.parse_date(ls[0], date))
+          for ls in map(lines, css(res, '.on'))]
+
+@fs.retry_if_timeout
+def aa(s, org, dst, date, dist_org=0, dist_dst=0):
+  """
+  dist_org and dist_dst are either 0, 30, 60, or 90 (miles).
+
+  Returns list of (best price, day) pairs for +/- 3 days around date.
+  """
+  for dist in dist_org, dist_dst:
+    if dist not in [None, 0, 30, 60, 90]:
+      raise Exception('dist_org/dist_dst must be in [0,30,60,90]')
+  doc = s.get(fs.urls['aa']).doc
+  setval(doc, 'flightSearchForm.originAirport', org)
+  setval(doc, 'flightSearchForm.destinationAirport', dst)
+  select(doc, 'flightSearchForm.originAlternateAirportDistance', dist_org)
+  select(doc, 'flightSearchForm.destinationAlternateAirportDistance', dist_dst)
+  check(doc, 'flightSearchForm.searchType.matrix')
+  select(doc, 'flightSearchForm.flightParams.flightDateParams.travelMonth', date.month)
+  select(doc, 'flightSearchForm.flightParams.flightDateParams.travelDay', date.day)
+  select(doc, 'flightSearchForm.flightParams.flightDateParams.searchTime', 120001)
+  check(doc, 'flightSearchForm.carrierAll')
+  res = s.submit(byid(doc, 'flightSearchForm')).doc
+  def gen():
+    for x in css(res, '.tabNotActive, .highlightSubHeader'):
+      day, prc = ' '.join(lines(x)).split('from')
+      yield fs.toprc(prc), fs.parse_date(day, date)
+  return list(gen())
+
+@fs.retry_if_timeout
+def virginamerica(s, org, dst, date):
+  """
+  Note that this airline has very limited airport options.
+
+  Returns list of (best price, day) pairs for +/- 3 days around date.
+  """
+  doc = s.get(fs.urls['virginamerica']).doc
+  check(doc, 'owRadio')
+  form = form_of(doc, 'SearchFlightBt')
+  res = s.submit(form, {
+    'flightSearch.origin': org.upper(),
+    'flightSearch.destination': dst.upper(),
+    'flightSearch.depDate.MMDDYYYY': fs.fmt_date(date),
+  }, submit='SearchFlightBt').doc
+  return [(fs.toprc(' '.join(lines(prc))), fs.parse_date(' '.join(lines(day)), date))
+      for prc, day in zip(res.xpath('//*[@class="fsCarouselCost"]'),
+                          res.xpath('//*[@class="fsCarouselDate"]'))]
+
+@fs.retry_if_timeout
+def bing(s, org, dst, date, near_org=False, near_dst=False):
+  """
+  Returns [(best price, date)], or [] if the price hadn't been filled in by
+  the time the (unscripted) results page was served.
+  """
+  doc = s.get(fs.urls['bing']).doc
+  check(doc, 'oneWayLabel')
+  setval(doc, 'orig1Text', org)
+  setval(doc, 'dest1Text', dst)
+  if near_org: check(doc, 'no1')
+  if near_dst: check(doc, 'ne1')
+  setval(doc, 'leave1', fs.fmt_date(date))
+  check(doc, 'PRI-HP', False)
+  res = s.submit(form_of(doc, 'leave1')).doc
+  return [(fs.toprc(' '.join(lines(x))), date)
+          for x in res.xpath('//span[@class="price"]')[:1]]
+
+@fs.retry_if_timeout
+def southwest(s, org, dst, date):
+  """
+  Returns list of (best price, date) pairs for month around date.
+  """
+  doc = s.get(fs.urls['southwest']).doc
+  check(doc, 'oneWay')
+  setval(doc, 'originAirport_displayed', org)
+  setval(doc, 'destinationAirport_displayed', dst)
+  select(doc, 'outboundDate', fs.fmt_date(fs.month_of(date)))
+  res = s.submit(form_of(doc, 'submitButton'), submit='submitButton').doc
+  month = ' '.join(lines(css(res, '.carouselTodaySodaIneligible .carouselBody')[0]))
+  def gen():
+    for x in css(res, '.fareAvailableDay'):
+      day, prc = lines(x)
+      yield fs.toprc(prc), fs.parse_date('%s %s' % (month, day), date)
+  return list(gen())
+
+@fs.retry_if_timeout
+def delta(s, org, dst, date, nearby=False):
+  """
+  Returns [(best price, date)].
+  """
+  doc = s.get(fs.urls['delta']).doc
+  # (oneway_link only reshapes the form client-side.)
+  setval(doc, 'departureCity_0', org)
+  setval(doc, 'destinationCity_0', dst)
+  if nearby: check(doc, 'flexAirports')
+  setval(doc, 'departureDate_0', fs.fmt_date(date))
+  res = s.submit(form_of(doc, 'Go'), submit='Go').doc
+  x = css(res, '.lowest .fares, .lowest .fares-requested')[0]
+  return [(fs.toprc(' '.join(lines(x))), date)]
+
+airlines = dict((f.__name__, f) for f in
+    [united, aa, virginamerica, bing, southwest, delta])
+
+class fixture_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """
+  Acts as an HTTP proxy that answers every request from the recorded
+  fixtures, keeping connections alive like the real sites.
+  """
+  protocol_version = 'HTTP/1.1'
+  def serve(self, method):
+    n = int(self.headers.getheader('content-length') or 0)
+    body = self.rfile.read(n) if n else None
+    try: resp = load_fixture(self.server.fixtures, method, self.path, body)
+    except KeyError:
+      self.send_error(404)
+      return
+    self.send_response(resp.status)
+    for k, v in resp.headers.iteritems():
+      if k != 'set-cookie': self.send_header(k, v)
+    self.send_header('Content-Length', len(resp.body))
+    self.end_headers()
+    self.wfile.write(resp.body)
+  def do_GET(self): self.serve('GET')
+  def do_POST(self): self.serve('POST')
+  def log_message(self, *args): pass
+
+class fixture_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """
+  Stand-in for the airline sites: point a session at it with
+  proxy='127.0.0.1:%s' % server.server_port.  Port 0 picks a free one.
+  """
+  daemon_threads = True
+  def __init__(self, fixtures, port=0):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), fixture_handler)
+    self.fixtures = path.path(fixtures)
+
+def main(argv=None):
+  p = argparse.ArgumentParser(description='Serve recorded fixtures as a '
+      'local stand-in for the airline sites.')
+  p.add_argument('fixtures', help='Fixture directory (see --record).')
+  p.add_argument('-p', '--port', type=int, default=8080)
+  cfg = p.parse_args(argv)
+  server = fixture_server(cfg.fixtures, cfg.port)
+  print 'serving %s on 127.0.0.1:%s' % (cfg.fixtures, server.server_port)
+  server.serve_forever()
+
+if __name__ == '__main__': main()
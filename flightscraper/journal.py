@@ -0,0 +1,56 @@
+"""
+Per-run journal: each search's results are appended to OUTDIR/journal.pickle
+(and synced to disk) as soon as the search finishes, so a run that dies part
+way keeps everything it had, and --resume OUTDIR can redo just the searches
+that are missing or failed.
+
+The journal is a stream of pickled records: first ('run', routes, now), then
+('done', label, group, res) or ('failed', label, traceback) per search.  A
+record cut short by a crash is ignored.
+"""
+
+import cPickle as pickle, collections, os, threading
+
+name = 'journal.pickle'
+
+class journal(object):
+  """
+  Appends to outdir's journal; starts a new one unless resuming.  Safe to
+  use from the pool's threads.
+  """
+  def __init__(self, outdir, routes, now, resume=False):
+    self.f = open(outdir / name, 'ab' if resume else 'wb')
+    self.lock = threading.Lock()
+    if not resume: self.append(('run', routes, now))
+  def append(self, record):
+    with self.lock:
+      pickle.dump(record, self.f, 2)
+      self.f.flush()
+      os.fsync(self.f.fileno())
+  def done(self, q, res): self.append(('done', q.label, q.group, res))
+  def failed(self, q, tb): self.append(('failed', q.label, tb))
+  def close(self): self.f.close()
+
+# done maps each finished label to its results; failed maps labels whose last
+# attempt raised to the traceback.
+contents = collections.namedtuple('contents', 'routes now done failed')
+
+def load(outdir):
+  done, failed = {}, {}
+  with open(outdir / name, 'rb') as f:
+    unpickler = pickle.Unpickler(f)
+    try: _, routes, now = unpickler.load()
+    except (EOFError, pickle.UnpicklingError):
+      raise ValueError('%s has no journal to resume from' % outdir)
+    while 1:
+      # A truncated last record can fail in all sorts of ways.
+      try: record = unpickler.load()
+      except Exception: break
+      if record[0] == 'done':
+        _, label, group, res = record
+        done[label] = res
+        failed.pop(label, None)
+      else:
+        _, label, tb = record
+        failed[label] = tb
+  return contents(routes, now, done, failed)
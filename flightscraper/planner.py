@@ -0,0 +1,146 @@
+"""
+Expands a declarative query spec (routes, date windows, nearby-airport
+options, airlines) into the fewest airline calls that cover every requested
+(route, date), using what each airline returns per call.
+
+A spec is a JSON file like:
+
+  {
+    "airlines": ["united", "aa", "virginamerica", "bing", "southwest", "delta"],
+    "routes": [
+      {"org": "sfo", "dst": "phl", "dates": ["2012-12-21"], "window": 3,
+       "nearby": true, "alt_orgs": ["sjc", "oak"]},
+      {"org": "sfo", "dst": "ewr", "dates": ["2013-01-02..2013-01-06"],
+       "airlines": ["united", "southwest"]}
+    ]
+  }
+
+dates are days or inclusive day ranges, each widened by +/- window days.
+A route's airlines default to the spec's, and the spec's to every registered
+one (see flightscraper.adapters).
+
+The planned calls are then scheduled most expensive first, by what they've
+been observed to cost.
+"""
+
+import collections, datetime as dt, heapq, json
+import flightscraper as fs
+from . import adapters
+
+route = collections.namedtuple('route', 'org dst dates nearby alt_orgs airlines')
+
+def parse_day(s): return dt.datetime.strptime(s, '%Y-%m-%d').date()
+
+def expand_dates(specs, window):
+  dates = set()
+  for s in specs:
+    lo, _, hi = s.partition('..')
+    lo = parse_day(lo)
+    hi = parse_day(hi) if hi else lo
+    for n in xrange((hi - lo).days + 1 + 2 * window):
+      dates.add(lo + dt.timedelta(days=n - window))
+  return sorted(dates)
+
+def load_spec(f): return parse_spec(json.load(f))
+
+def parse_spec(spec):
+  """Returns the routes of the already-parsed JSON spec."""
+  default_airlines = spec.get('airlines', list(adapters.registry))
+  def parse_route(r):
+    airlines = r.get('airlines', default_airlines)
+    for airline in airlines: adapters.get(airline)
+    return route(r['org'].lower(), r['dst'].lower(),
+                 expand_dates(r['dates'], r.get('window', 0)),
+                 r.get('nearby', False),
+                 [o.lower() for o in r.get('alt_orgs', [])], airlines)
+  return map(parse_route, spec['routes'])
+
+def default_spec():
+  """The search this program always ran before specs existed."""
+  return [route('sfo', 'phl', expand_dates(['2012-12-21'], 3), True,
+                ['sjc', 'oak'],
+                ['united', 'aa', 'virginamerica', 'bing', 'southwest', 'delta'])]
+
+def cover(kind, dates):
+  """
+  Fewest call dates whose coverage includes all of dates (sorted).
+  """
+  if kind == 'day': return list(dates)
+  if kind == 'month':
+    months = collections.OrderedDict()
+    for d in dates: months.setdefault(fs.month_of(d), d)
+    return months.values()
+  # Greedy interval cover is optimal here: center each call 3 days after
+  # the earliest date not yet covered.
+  calls = []
+  for d in dates:
+    if not calls or (d - calls[-1]).days > 3:
+      calls.append(d + dt.timedelta(days=3))
+  return calls
+
+def plan(routes):
+  """
+  Returns the fs.query list covering routes.  Labels and groups are just the
+  airline name where that's unambiguous, gaining the route and date as
+  needed.
+  """
+  multi = len(routes) > 1
+  queries = []
+  # (airline, args, kw) -> index in queries, to search a call that several
+  # routes need (e.g. one's alternate origin is another's origin) just once
+  seen = {}
+  for r in routes:
+    for airline in r.airlines:
+      a = adapters.get(airline)
+      kw = a.nearby_kw if r.nearby else {}
+      orgs = [r.org] + (r.alt_orgs if a.alt_orgs else [])
+      for org in orgs:
+        if not a.serves(org, r.dst): continue
+        group = '%s %s to %s' % (airline, org, r.dst) \
+                if multi or a.alt_orgs else airline
+        dates = cover(a.coverage, r.dates)
+        for date in dates:
+          label = group if a.coverage != 'day' and len(dates) == 1 else \
+                  '%s %s' % (group, date)
+          args = (org, r.dst, date)
+          key = airline, args, tuple(sorted(kw.iteritems()))
+          if key in seen:
+            q = queries[seen[key]]
+            queries[seen[key]] = q._replace(routes=q.routes + ((r.org, r.dst),))
+            continue
+          seen[key] = len(queries)
+          queries.append(fs.query(group, label, airline, args, dict(kw),
+                                  ((r.org, r.dst),)))
+  # Different calls that came out with the same label get their dates added.
+  labels = collections.Counter(q.label for q in queries)
+  return [q._replace(label='%s %s' % (q.group, q.args[2]))
+          if labels[q.label] > 1 else q for q in queries]
+
+def naive_calls(routes):
+  """Calls needed with one per airline per requested date, for comparison."""
+  return sum(len(r.dates) * (1 + (len(r.alt_orgs) if adapters.get(a).alt_orgs else 0))
+             for r in routes for a in r.airlines)
+
+def schedule(queries, policy, key=lambda q: q.airline):
+  """
+  queries, most expensive first (see adapters.adapter.cost; ties keep their
+  order), where key gives a query's airline.  Workers each taking the next
+  one as they come free then makes for a short run: the long and
+  failure-prone searches start early rather than leaving one worker busy
+  after the others are done.
+  """
+  costs = dict((a, adapters.get(a).cost(policy)) for a in set(map(key, queries)))
+  return sorted(queries, key=lambda q: -costs[key(q)])
+
+def estimate(queries, policy, workers=1):
+  """Estimated wall-clock seconds to run the scheduled queries on workers sessions."""
+  free = [0.] * workers
+  for q in schedule(queries, policy):
+    heapq.heapreplace(free, free[0] + adapters.get(q.airline).cost(policy))
+  return max(free)
+
+def describe(routes, queries, policy, workers=1):
+  secs = estimate(queries, policy, workers)
+  return 'planned %s airline calls for %s route(s) (vs %s one per date), ' \
+         'est. %dm%02ds on %s worker(s)' % (len(queries), len(routes),
+         naive_calls(routes), secs // 60, secs % 60, workers)
@@ -0,0 +1,451 @@
+"""
+Renders a run's results as the text and HTML emails and the full HTML report.
+pyjade and Jinja2 are loaded along with this module, the first time a report
+is rendered.
+"""
+
+import cPickle as pickle, calendar, collections, hashlib, json, os, urllib, \
+    jinja2, pyjade, pyjade.utils, pyjade.ext.jinja, __builtin__, path
+import flightscraper as fs
+from . import fares, timing
+
+jinja_env = jinja2.Environment(extensions=['pyjade.ext.jinja.PyJadeExtension'])
+compiled_tmpls = {}
+def jade2html(tmpl, globals, locals):
+  # Each template is compiled (via Jinja2, to Python bytecode) once per
+  # process; rendering then just runs it.
+  if tmpl not in compiled_tmpls:
+    compiled_tmpls[tmpl] = jinja_env.from_string(pyjade.utils.process(tmpl,
+      compiler=pyjade.ext.jinja.Compiler))
+  env = dict(vars(__builtin__))
+  env.update(globals)
+  env.update(locals)
+  return compiled_tmpls[tmpl].render(env)
+
+# One calendar cell: best is the cheapest price as '$123' ('-' if none), and
+# full is whether every group had a result that day.
+day_summary = collections.namedtuple('day_summary', 'day dow date best full')
+
+def month_summary(cal, date, table, ngroups):
+  """
+  The weeks of date's month as rows of day_summary, from the fares.fare_table
+  table and computed once for all the reports.  Days outside the month have
+  day 0.
+  """
+  def cell(day, dow):
+    if day == 0: return day_summary(day, dow, None, '-', False)
+    dat = date.replace(day=day)
+    best = table.best(dat)
+    return day_summary(day, dow, dat, '-' if best is None else '$%s' % best,
+                       table.ngroups_on(dat) == ngroups)
+  return [[cell(day, dow) for day, dow in week]
+          for week in cal.monthdays2calendar(*date.timetuple()[:2])]
+
+email_tmpl = '''
+!!! 5
+html(lang='en')
+  body
+    table.table.table-bordered
+      thead
+        tr
+          for dow in cal.iterweekdays()
+            th= calendar.day_abbr[dow]
+      tbody
+        for week in weeks
+          tr
+            for c in week
+              td
+                if c.day > 0
+                  .day-number= c.day
+                  if c.full
+                    .full.price= c.best
+                  else
+                    .partial.price -
+    if missing
+      p Prices are partial without:
+      ul
+        for group, label, why in missing
+          li #{label} (#{why})
+    a(href=report_url) See full report
+'''
+
+full_tmpl = '''
+!!! 5
+html(lang='en')
+  head
+    title Flight Scraper Results for #{fmt_time(now)}
+    link(href='//netdna.bootstrapcdn.com/twitter-bootstrap/2.1.1/css/bootstrap-combined.min.css', rel='stylesheet')
+    link(href='../main.css', rel='stylesheet')
+  body
+    h1 Flight Scraper Results for #{fmt_time(now)}
+    a(href=index_url) All routes and months
+    table.table.table-bordered
+      thead
+        tr
+          for dow in cal.iterweekdays()
+            th= calendar.day_abbr[dow]
+      tbody
+        for week in weeks
+          tr
+            for c in week
+              td
+                if c.day > 0
+                  .day-number= c.day
+                  if c.full
+                    .full.price= c.best
+                  else
+                    .partial.price= c.best
+    if missing
+      .alert
+        | Prices are partial without these searches:
+        ul.missing
+          for group, label, why in missing
+            li
+              a(href="#label-#{label_ids[label]}")
+                strong= label
+              |  #{why}
+    table.table.table-striped.table-hover
+      col
+      col
+      col
+      col(style='text-align: right')
+      thead
+        tr
+          th Date
+          th Search
+          th Price
+      tbody
+        for date, res in table.by_date()
+          for r in res
+            tr
+              td= date
+              td
+                a(href="#label-#{label_ids[r.label]}")= r.label
+              td $#{r.prc}
+    if timings
+      h2 Timing
+      table.table.table-condensed.timing
+        thead
+          tr
+            th Search
+            th Total
+            for name in phases
+              th= name
+            th Retries
+            th Element retries
+            th Timeouts
+            th Slowest element wait
+            if pages
+              th Page data
+              th Lean saved
+        tbody
+          for t in timings
+            tr
+              td
+                if t.label in label_ids
+                  a(href="#label-#{label_ids[t.label]}")= t.label
+                else
+                  = t.label
+              td= fmt_secs(t.secs)
+              for name in phases
+                td= fmt_secs(t.phases.get(name, 0))
+              td= t.retries
+              td= t.lookup_retries
+              td= t.timeouts
+              td
+                if t.slowest_wait
+                  code= t.slowest_wait[0]
+                  |  #{fmt_secs(t.slowest_wait[1])}
+              if pages
+                td= fmt_bytes(t.page_bytes)
+                td
+                  if t.saved
+                    | #{fmt_bytes(t.saved[0])}, #{fmt_secs(t.saved[1])}
+    .screenshots
+      for i, label in enumerate(labels)
+        a(name="label-#{i}")
+        h2= label
+        if pre_path(label) in thumbs
+          h3 Pre-submit
+          a(href="#{pre_path(label)}")
+            img.scrthumb(src="#{thumbs[pre_path(label)]}", loading="lazy")
+        if post_path(label) in thumbs
+          h3 Post-submit
+          a(href="#{post_path(label)}")
+            img.scrthumb(src="#{thumbs[post_path(label)]}", loading="lazy")
+    script(src='//ajax.googleapis.com/ajax/libs/jquery/1.8.2/jquery.min.js')
+    script(src='//netdna.bootstrapcdn.com/twitter-bootstrap/2.1.1/js/bootstrap.min.js')
+    script(src='main.js')
+  '''
+
+# The report set (see render_set): an index of routes by month, and per route
+# a page per month and one of screenshots.
+
+index_tmpl = '''
+!!! 5
+html(lang='en')
+  head
+    title Flight Scraper Results for #{fmt_time(now)}
+    link(href='//netdna.bootstrapcdn.com/twitter-bootstrap/2.1.1/css/bootstrap-combined.min.css', rel='stylesheet')
+    link(href=css, rel='stylesheet')
+  body
+    h1 Flight Scraper Results for #{fmt_time(now)}
+    table.table.table-bordered
+      thead
+        tr
+          th Route
+          for month in months
+            th= month.strftime('%b %Y')
+      tbody
+        for org, dst, dir, shots, bests in routes
+          tr
+            td
+              = org|upper
+              |  to #{dst|upper}
+              if shots
+                |  (
+                a(href="#{dir}/screenshots.html") screenshots
+                | )
+            for month, best in bests
+              td
+                if best is not none
+                  a(href="#{dir}/#{month_page(month)}") $#{best}
+                elif month in route_months[dir]
+                  a.partial(href="#{dir}/#{month_page(month)}") -
+    if missing
+      .alert
+        | Prices are partial without these searches:
+        ul.missing
+          for group, label, why in missing
+            li
+              strong= label
+              |  #{why}
+  '''
+
+month_tmpl = '''
+!!! 5
+html(lang='en')
+  head
+    title #{org|upper} to #{dst|upper}, #{month.strftime('%B %Y')}
+    link(href='//netdna.bootstrapcdn.com/twitter-bootstrap/2.1.1/css/bootstrap-combined.min.css', rel='stylesheet')
+    link(href=css, rel='stylesheet')
+  body
+    h1 #{org|upper} to #{dst|upper}, #{month.strftime('%B %Y')}
+    ul.pager
+      li
+        a(href='../index.html') All routes
+      for m in months
+        li
+          if m == month
+            strong= m.strftime('%b %Y')
+          else
+            a(href=month_page(m))= m.strftime('%b %Y')
+    table.table.table-bordered
+      thead
+        tr
+          for dow in cal.iterweekdays()
+            th= calendar.day_abbr[dow]
+      tbody
+        for week in weeks
+          tr
+            for c in week
+              td
+                if c.day > 0
+                  .day-number= c.day
+                  if c.full
+                    .full.price= c.best
+                  else
+                    .partial.price= c.best
+    if missing
+      .alert
+        | Prices are partial without these searches:
+        ul.missing
+          for group, label, why in missing
+            li
+              strong= label
+              |  #{why}
+    table.table.table-striped.table-hover
+      thead
+        tr
+          th Date
+          th Search
+          th Price
+      tbody
+        for date, r in rows
+          tr
+            td= date
+            td= r.label
+            td $#{r.prc}
+    if npages > 1
+      .pagination
+        ul
+          for i in range(1, npages + 1)
+            if i == page
+              li.active
+                a(href=month_page(month, i))= i
+            else
+              li
+                a(href=month_page(month, i))= i
+  '''
+
+shots_tmpl = '''
+!!! 5
+html(lang='en')
+  head
+    title #{org|upper} to #{dst|upper} screenshots
+    link(href='//netdna.bootstrapcdn.com/twitter-bootstrap/2.1.1/css/bootstrap-combined.min.css', rel='stylesheet')
+    link(href=css, rel='stylesheet')
+  body
+    h1 #{org|upper} to #{dst|upper} screenshots
+    a(href='../index.html') All routes
+    for label, shots in labels
+      h2= label
+      for title, full, thumb in shots
+        h3= title
+        a(href=full)
+          img.scrthumb(src=thumb, loading='lazy')
+  '''
+
+# Fares per page of a month page's list.
+page_size = 100
+
+def route_dir(org, dst): return '%s-%s' % (org, dst)
+def month_page(month, page=1):
+  return '%s%s.html' % (month.strftime('%Y-%m'), '' if page == 1 else '.%s' % page)
+
+def render_set(cfg, routes, by_route, thumbs, missing):
+  """
+  Writes the report set for routes (planner.route) to cfg.site, or else the
+  run's output directory: index.html, and per route ORG-DST/YYYY-MM.html
+  (with .2.html and so on past page_size fares) for each month of its dates
+  and ORG-DST/screenshots.html.  by_route maps (org, dst) to raw_res (as
+  built by script()), thumbs is as for render, and missing is (route,
+  group, label, why) per search that failed or was skipped.
+
+  A page is only rendered if what goes into it changed since it was last
+  written, as recorded in reports.json, so a site kept across runs (or a
+  resumed run) only rewrites the routes and months with new results.
+  Returns the names of the pages written.
+  """
+  cal = calendar.Calendar(6)
+  base = path.path(cfg.site or cfg.outdir)
+  manifest_path = base / 'reports.json'
+  manifest = {}
+  if manifest_path.exists():
+    with open(manifest_path) as f: manifest = json.load(f)
+  written = []
+  def page(name, tmpl, **env):
+    # The stylesheet is in the web root, above base.
+    env['css'] = os.path.relpath(base.parent / 'main.css', (base / name).parent)
+    digest = hashlib.sha1(pickle.dumps((tmpl, sorted(env.items())), 2)).hexdigest()
+    if manifest.get(name) == digest and (base / name).exists(): return
+    (base / name).parent.makedirs_p()
+    html = jade2html(tmpl, globals(), dict(env, cal=cal, fmt_time=fs.fmt_time))
+    with open(base / name, 'w') as f: f.write(html)
+    manifest[name] = digest
+    written.append(name)
+
+  index_rows, route_months = [], {}
+  all_months = set()
+  for r in routes:
+    d = route_dir(r.org, r.dst)
+    table = fares.fare_table(by_route.get((r.org, r.dst), []))
+    rmissing = [(g, label, why) for route, g, label, why in missing
+                if route == (r.org, r.dst)]
+    for g, label, why in rmissing: table.group_id(g)
+    months = sorted(set(fs.month_of(date) for date in r.dates))
+    route_months[d] = months
+    all_months.update(months)
+    for month in months:
+      rows = [(date, f) for date, res in table.by_date(month) for f in res]
+      npages = max(1, (len(rows) + page_size - 1) // page_size)
+      names = ['%s/%s' % (d, month_page(month, i + 1)) for i in xrange(npages)]
+      for i, name in enumerate(names):
+        page(name, month_tmpl, org=r.org, dst=r.dst, month=month, months=months,
+             weeks=month_summary(cal, month, table, table.ngroups()),
+             rows=rows[i * page_size:(i + 1) * page_size], page=i + 1,
+             npages=npages, missing=rmissing)
+      # Pages past the last, from when the month had more fares.
+      prefix = '%s/%s.' % (d, month.strftime('%Y-%m'))
+      for name in [n for n in manifest if n.startswith(prefix) and n not in names]:
+        del manifest[name]
+        if (base / name).exists(): (base / name).remove()
+    labels = []
+    for group, (label, res) in by_route.get((r.org, r.dst), []):
+      pngs = [(title, os.path.relpath(cfg.outdir / name, base / d),
+               os.path.relpath(cfg.outdir / thumbs[name], base / d))
+              for title, name in [('Pre-submit', fs.pre_path(label)),
+                                  ('Post-submit', fs.post_path(label))]
+              if name in thumbs]
+      if pngs: labels.append((label, pngs))
+    if labels:
+      page('%s/screenshots.html' % d, shots_tmpl, org=r.org, dst=r.dst,
+           labels=labels)
+    index_rows.append((r.org, r.dst, d, bool(labels),
+                       dict((m, table.best_in(m)) for m in months)))
+  months = sorted(all_months)
+  page('index.html', index_tmpl, now=cfg.now, months=months,
+       route_months=route_months,
+       missing=[(g, label, why) for route, g, label, why in missing],
+       routes=[(org, dst, d, shots, [(m, bests.get(m)) for m in months])
+               for org, dst, d, shots, bests in index_rows])
+
+  tmp = '%s.%s.tmp' % (manifest_path, os.getpid())
+  with open(tmp, 'w') as f: json.dump(manifest, f, indent=1, sort_keys=True)
+  os.rename(tmp, manifest_path)
+  return written
+
+def fmt_secs(secs): return '%.1fs' % secs
+def fmt_bytes(n): return '%.0fKB' % (n / 1024.)
+
+def render(cfg, raw_res, date, thumbs, timings=(), missing=()):
+  """
+  Writes the full report for raw_res (as built by script()) around date's
+  month and returns (email text, email HTML).  thumbs maps each screenshot
+  written to its thumbnail, timings are the searches' timing.search_timing
+  rows, slowest first, and missing is (group, label, why) per search that
+  failed or was skipped.  Days can't be full without the missing groups.
+  """
+  cal = calendar.Calendar(6)
+  report_url = cfg.urlbase / urllib.quote(cfg.outdir) / fs.html_path
+
+  table = fares.fare_table(raw_res)
+  for group, label, why in missing: table.group_id(group)
+  weeks = month_summary(cal, date, table, table.ngroups())
+  # Failed searches too, for the screenshots --screenshots=failures keeps.
+  labels = sorted(set(table.labels) | set(label for group, label, why in missing))
+  label_ids = dict((label, i) for i, label in enumerate(labels))
+
+  # email text report
+  def gen_vals():
+    for dow in cal.iterweekdays():
+      yield '%6s' % calendar.day_abbr[dow]
+    yield '\n'
+    for week in weeks:
+      for c in week:
+        val = c.best if c.day > 0 and c.full else ''
+        yield '%6s%s' % (val, '\n' if c.dow == 5 else '')
+  def gen_days():
+    for week in weeks:
+      for c in week:
+        yield '%6s%s' % ('' if c.day == 0 else c.day, '\n' if c.dow == 5 else '')
+  vals = ''.join(gen_vals()).split('\n')
+  days = ''.join(gen_days()).split('\n')
+  email_text = '\n'.join(line for lines in zip(vals, days) for line in lines)
+  if missing:
+    email_text += '\n\nPrices are partial without:\n' + '\n'.join(
+        '  %s (%s)' % (label, why) for group, label, why in missing)
+  email_text = '%s\n\n<%s>' % (email_text, report_url)
+
+  env = dict(cal=cal, weeks=weeks, table=table, labels=labels,
+             label_ids=label_ids, report_url=report_url, pre_path=fs.pre_path,
+             post_path=fs.post_path, thumbs=thumbs, now=cfg.now,
+             fmt_time=fs.fmt_time, timings=timings, phases=timing.phases,
+             missing=missing, pages=any(t.page_bytes for t in timings),
+             index_url=os.path.relpath(path.path(cfg.site or cfg.outdir) / 'index.html',
+                                       cfg.outdir))
+  email_html = jade2html(email_tmpl, globals(), env)
+  html = jade2html(full_tmpl, globals(), env)
+  with open(cfg.outdir / fs.html_path, 'w') as f:
+    f.write(html)
+  return email_text, email_html
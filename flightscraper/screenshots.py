@@ -0,0 +1,73 @@
+"""
+Background screenshot writer.  Scrapers hand over raw PNG bytes and move on;
+a thread re-compresses them, makes thumbnails for the report, and stores
+identical frames only once (further copies are hard links).
+"""
+
+import Queue, hashlib, os, shutil, StringIO, threading, path
+
+Image = None
+def load_pil():
+  """
+  Imports PIL (on the writer thread, once there's a screenshot to write);
+  returns False if it isn't installed.
+  """
+  global Image
+  if Image is None:
+    try: from PIL import Image
+    except ImportError: Image = False
+  return Image
+
+def thumb_name(name): return '%s.thumb.png' % name[:-len('.png')]
+
+class writer(object):
+  """
+  Writes screenshots named name (relative to outdir) as they're put.  Once
+  closed, thumbs maps each written name to its thumbnail (the name itself
+  if PIL isn't available).
+  """
+  def __init__(self, outdir, thumb_size=(400, 300)):
+    self.outdir = path.path(outdir)
+    self.thumb_size = thumb_size
+    self.queue = Queue.Queue()
+    self.by_hash = {}
+    self.thumbs = {}
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+  def put(self, name, png): self.queue.put((name, png))
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+  def run(self):
+    while 1:
+      item = self.queue.get()
+      if item is None: return
+      try: self.write(*item)
+      except Exception: pass # a lost screenshot shouldn't take the run down
+  def write(self, name, png):
+    digest = hashlib.sha1(png).hexdigest()
+    if digest in self.by_hash:
+      first = self.by_hash[digest]
+      link(self.outdir / first, self.outdir / name)
+      if self.thumbs[first] != first:
+        link(self.outdir / self.thumbs[first], self.outdir / thumb_name(name))
+        self.thumbs[name] = thumb_name(name)
+      else:
+        self.thumbs[name] = name
+      return
+    self.by_hash[digest] = name
+    if not load_pil():
+      with open(self.outdir / name, 'wb') as f: f.write(png)
+      self.thumbs[name] = name
+      return
+    img = Image.open(StringIO.StringIO(png))
+    img.save(self.outdir / name, 'PNG', optimize=True)
+    img.thumbnail(self.thumb_size, Image.ANTIALIAS)
+    img.save(self.outdir / thumb_name(name), 'PNG', optimize=True)
+    self.thumbs[name] = thumb_name(name)
+
+def link(src, dst):
+  if os.path.exists(dst): os.remove(dst)
+  try: os.link(src, dst)
+  except OSError: shutil.copyfile(src, dst)
@@ -0,0 +1,158 @@
+"""
+Append-only store of fare observations, one row per (run, label, travel date)
+price, indexed so that trend questions over years of runs don't need to
+unpickle every old output directory.
+"""
+
+import cPickle as pickle, argparse, datetime as dt, os, sqlite3, sys, time, path
+
+schema = '''
+create table if not exists runs (
+  observed real not null,
+  source text unique
+);
+create table if not exists fares (
+  observed real not null, -- unix time of the run
+  org text not null,
+  dst text not null,
+  date text not null,     -- travel date, YYYY-MM-DD
+  grp text not null,
+  label text not null,
+  prc integer not null
+);
+create index if not exists fares_by_route
+  on fares (org, dst, observed, date, prc);
+create index if not exists fares_by_label
+  on fares (label, observed, date, prc);
+'''
+
+def timestamp(t): return time.mktime(t.timetuple())
+
+class fare_store(object):
+  def __init__(self, db):
+    path.path(db).abspath().parent.makedirs_p()
+    self.db = sqlite3.connect(db)
+    self.db.executescript(schema)
+  def close(self): self.db.close()
+  def append(self, observed, org, dst, raw_res, source=None, replace=False):
+    """
+    Records one run's raw_res (as built by script()) for the route org to
+    dst, observed at datetime observed.  Returns False without writing if a
+    run from source was already recorded.  With replace (a resumed run),
+    whatever was recorded for the route at observed is replaced instead.
+    """
+    t = timestamp(observed)
+    with self.db:
+      if replace:
+        self.db.execute('delete from fares where observed = ? and org = ? and '
+                        'dst = ?', (t, org.lower(), dst.lower()))
+      if not replace or not self.db.execute('select 1 from runs where '
+          'observed = ? and source is ?', (t, source)).fetchone():
+        try:
+          self.db.execute('insert into runs values (?, ?)', (t, source))
+        except sqlite3.IntegrityError:
+          return False
+      self.db.executemany('insert into fares values (?, ?, ?, ?, ?, ?, ?)',
+          ((t, org.lower(), dst.lower(), date.isoformat(), group, label, prc)
+           for group, (label, res) in raw_res for prc, date in res))
+    return True
+  def cheapest(self, org, dst, days, now=None):
+    """
+    Returns [(travel date, cheapest price)] seen for the route in the last
+    days days, ordered by travel date.
+    """
+    since = timestamp(now or dt.datetime.now()) - days * 86400
+    return [(parse_iso(date), prc) for date, prc in self.db.execute('''
+      select date, min(prc) from fares
+      where org = ? and dst = ? and observed >= ?
+      group by date order by date''', (org.lower(), dst.lower(), since))]
+  def previous(self, org, dst, before):
+    """
+    [(label, travel date, price)] of the route's last run observed before
+    datetime before; empty if there's none.
+    """
+    org, dst = org.lower(), dst.lower()
+    return [(label, parse_iso(date), prc) for label, date, prc in self.db.execute('''
+      select label, date, prc from fares
+      where org = ? and dst = ? and observed = (
+        select max(observed) from fares
+        where org = ? and dst = ? and observed < ?)''',
+      (org, dst, org, dst, timestamp(before)))]
+  def history(self, label, date=None):
+    """
+    Returns [(observed datetime, travel date, price)] for label, oldest first,
+    optionally for a single travel date.
+    """
+    q = 'select observed, date, prc from fares where label = ?'
+    args = [label]
+    if date is not None:
+      q += ' and date = ?'
+      args.append(date.isoformat())
+    return [(dt.datetime.fromtimestamp(observed), parse_iso(date), prc)
+            for observed, date, prc in self.db.execute(q + ' order by observed', args)]
+  def labels(self):
+    return [label for label, in self.db.execute(
+      'select distinct label from fares order by label')]
+
+def parse_iso(date): return dt.date(*map(int, date.split('-')))
+
+def run_time(outdir):
+  """
+  When the run that wrote outdir happened: its default name (see fmt_time),
+  else the mtime of its results.pickle.
+  """
+  try: return dt.datetime.strptime(outdir.name, '%a %Y-%m-%d %I:%M %p')
+  except ValueError:
+    return dt.datetime.fromtimestamp((outdir / 'results.pickle').getmtime())
+
+def load_results(p):
+  """
+  (org, dst) -> raw_res from results.pickle p.  Runs from before specs (and
+  routes) existed pickled just their raw_res, which comes back keyed by None.
+  """
+  with open(p) as f: res = pickle.load(f)
+  return res if isinstance(res, dict) else {None: res}
+
+def import_pickles(store, outdirs, org, dst):
+  """
+  One-time import of old output directories' results.pickle files, of the
+  route org to dst (or whatever route an old one has).  Already imported
+  directories are skipped, so this can be rerun.  Returns the number of runs
+  imported.
+  """
+  n = 0
+  for outdir in map(path.path, outdirs):
+    p = outdir / 'results.pickle'
+    if not p.exists(): continue
+    by_route = load_results(p)
+    raw_res = by_route.get((org.lower(), dst.lower()), by_route.get(None))
+    if raw_res is None: continue
+    n += store.append(run_time(outdir), org, dst, raw_res, p.abspath())
+  return n
+
+def main(argv=sys.argv):
+  p = argparse.ArgumentParser(description='Query or import into the fare store.')
+  p.add_argument('--db', default='~/.flightscraper/fares.sqlite',
+      help='Store location. (default: %(default)s)')
+  sub = p.add_subparsers(dest='cmd')
+  s = sub.add_parser('import', help='Import old output directories.')
+  s.add_argument('org')
+  s.add_argument('dst')
+  s.add_argument('outdirs', nargs='+')
+  s = sub.add_parser('cheapest', help='Cheapest fare per travel date.')
+  s.add_argument('org')
+  s.add_argument('dst')
+  s.add_argument('-n', '--days', type=int, default=7,
+      help='Only consider observations from the last this many days.')
+  s = sub.add_parser('history', help='Price history for a label.')
+  s.add_argument('label')
+  cfg = p.parse_args(argv[1:])
+  store = fare_store(os.path.expanduser(cfg.db))
+  if cfg.cmd == 'import':
+    print 'imported %s runs' % import_pickles(store, cfg.outdirs, cfg.org, cfg.dst)
+  elif cfg.cmd == 'cheapest':
+    for date, prc in store.cheapest(cfg.org, cfg.dst, cfg.days):
+      print '%s  $%s' % (date, prc)
+  else:
+    for observed, date, prc in store.history(cfg.label):
+      print '%s  %s  $%s' % (observed, date, prc)
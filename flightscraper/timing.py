@@ -0,0 +1,191 @@
+"""
+Hierarchical timing spans for a run: the run, each search under it, and each
+search's phases (navigate, fill, submit, wait, extract, screenshot), with
+counters such as retries and timeouts.  Spans nest per thread, so code deep
+inside an airline function can count or switch phase without being handed
+anything.
+
+The tree is written as profile.json next to results.pickle, and optionally
+as a Prometheus textfile-collector file.
+"""
+
+import collections, contextlib, json, os, threading, time
+
+local = threading.local()
+
+# The phases of a search, in the order they happen.
+phases = ['navigate', 'fill', 'submit', 'wait', 'extract', 'screenshot']
+
+class span(object):
+  """
+  A timed region.  Phases are children that accumulate time across however
+  many times the span switches back into them, so e.g. every element wait
+  of a search adds up in its one 'wait' phase.
+  """
+  def __init__(self, name, attrs={}, is_phase=False):
+    self.name, self.attrs, self.is_phase = name, dict(attrs), is_phase
+    self.start = time.time()
+    self.secs = 0 if is_phase else None
+    self.children = []
+    self.counts = collections.Counter()
+    self.running = None
+  def phase(self, name):
+    """
+    Ends the running phase, if any, and starts (or resumes) phase name; None
+    just ends it.
+    """
+    now = time.time()
+    if self.running is not None:
+      if self.running[0].name == name: return
+      self.running[0].secs += now - self.running[1]
+      self.running = None
+    if name is None: return
+    for child in self.children:
+      if child.is_phase and child.name == name: break
+    else:
+      child = span(name, is_phase=True)
+      self.children.append(child)
+    self.running = child, now
+  def end(self):
+    self.phase(None)
+    self.secs = time.time() - self.start
+  def phases(self):
+    return dict((c.name, c.secs) for c in self.children if c.is_phase)
+  def walk(self):
+    yield self
+    for child in self.children:
+      for s in child.walk(): yield s
+  def to_json(self):
+    d = dict(name=self.name, secs=round(self.secs or 0, 4))
+    if not self.is_phase: d['start'] = self.start
+    if self.attrs: d.update(self.attrs)
+    if self.counts: d['counts'] = dict(self.counts)
+    if self.children: d['children'] = [c.to_json() for c in self.children]
+    return d
+
+def from_json(d):
+  """The span d (from span.to_json) was made from, e.g. by a cluster worker."""
+  keys = 'name', 'secs', 'start', 'counts', 'children'
+  s = span(d['name'], dict((k, v) for k, v in d.iteritems() if k not in keys),
+           is_phase='start' not in d)
+  s.secs, s.start = d['secs'], d.get('start', s.start)
+  s.counts.update(d.get('counts', {}))
+  s.children = [from_json(c) for c in d.get('children', [])]
+  return s
+
+def stack():
+  if not hasattr(local, 'stack'): local.stack = []
+  return local.stack
+
+def current():
+  """This thread's innermost span, or None."""
+  s = stack()
+  return s[-1] if s else None
+
+@contextlib.contextmanager
+def timed(name, parent=None, **attrs):
+  """
+  Times the block as a span under parent (default: this thread's current
+  span), which it's the current span within.  Pass parent explicitly to nest
+  under a span from another thread, e.g. a pool worker's search under the run.
+  """
+  s = span(name, attrs)
+  parent = parent or current()
+  if parent is not None: parent.children.append(s)
+  stack().append(s)
+  try: yield s
+  finally:
+    stack().pop()
+    s.end()
+
+def phase(name):
+  """Switches the current span to phase name; a no-op outside any span."""
+  s = current()
+  if s is not None: s.phase(name)
+
+def current_phase():
+  s = current()
+  return s.running[0].name if s is not None and s.running else None
+
+def count(key, n=1):
+  s = current()
+  if s is not None: s.counts[key] += n
+
+def write_json(root, out):
+  with open(out, 'w') as f: json.dump(root.to_json(), f, indent=1, sort_keys=True)
+
+def label_str(labels):
+  return ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                  for k, v in sorted(labels.iteritems()))
+
+def write_prometheus(root, out):
+  """
+  Writes the run's metrics in the Prometheus text format, atomically (the
+  textfile collector may read at any moment).  Searches are the spans with an
+  airline attribute.
+  """
+  searches = [s for s in root.walk() if 'airline' in s.attrs]
+  lines = [
+    '# HELP flightscraper_run_seconds Wall-clock time of the last run.',
+    '# TYPE flightscraper_run_seconds gauge',
+    'flightscraper_run_seconds %.3f' % root.secs,
+    '# HELP flightscraper_run_timestamp_seconds When the last run finished.',
+    '# TYPE flightscraper_run_timestamp_seconds gauge',
+    'flightscraper_run_timestamp_seconds %.0f' % (root.start + root.secs),
+    '# HELP flightscraper_search_seconds Time per search in the last run.',
+    '# TYPE flightscraper_search_seconds gauge',
+  ]
+  for s in searches:
+    lines.append('flightscraper_search_seconds{%s} %.3f' % (
+        label_str(dict(label=s.name, airline=s.attrs['airline'])), s.secs))
+  phase_secs = collections.defaultdict(float)
+  counts = collections.defaultdict(collections.Counter)
+  for s in searches:
+    for name, secs in s.phases().iteritems():
+      phase_secs[s.attrs['airline'], name] += secs
+    for t in s.walk(): counts[s.attrs['airline']].update(t.counts)
+  lines += ['# HELP flightscraper_phase_seconds Time per airline and phase in the last run.',
+            '# TYPE flightscraper_phase_seconds gauge']
+  for (airline, name), secs in sorted(phase_secs.iteritems()):
+    lines.append('flightscraper_phase_seconds{%s} %.3f' % (
+        label_str(dict(airline=airline, phase=name)), secs))
+  keys = sorted(set(k for c in counts.itervalues() for k in c))
+  for key in keys:
+    lines += ['# HELP flightscraper_%s Count of %s per airline in the last run.' % (key, key),
+              '# TYPE flightscraper_%s gauge' % key]
+    for airline, c in sorted(counts.iteritems()):
+      lines.append('flightscraper_%s{%s} %s' % (key, label_str(dict(airline=airline)), c[key]))
+  tmp = '%s.%s.tmp' % (out, os.getpid())
+  with open(tmp, 'w') as f: f.write('\n'.join(lines) + '\n')
+  os.rename(tmp, out)
+
+# One row of the report's timing table: retries are of the whole airline
+# function, lookup_retries of element lookups, and timeouts of either.
+# page_bytes is what the search's pages transferred (0 if unknown, e.g. over
+# http), and saved is (bytes, seconds) saved by lean page loads, or None.
+search_timing = collections.namedtuple('search_timing',
+    'label airline secs phases retries lookup_retries timeouts slowest_wait '
+    'page_bytes saved')
+
+def search_timings(root, waits, baselines={}):
+  """
+  Per search, slowest first: its timing, and its slowest element wait from
+  waits ((label, method, selector, seconds) rows) as (selector, seconds).
+  Lean searches (with a pages='lean' attribute) are compared with baselines,
+  airline -> (bytes, navigate seconds) of full page loads.
+  """
+  slowest = {}
+  for label, method, x, secs in waits:
+    if secs > slowest.get(label, (None, -1))[1]: slowest[label] = x, secs
+  def row(s):
+    counts = sum((t.counts for t in s.walk()), collections.Counter())
+    base = baselines.get(s.attrs['airline'])
+    saved = (base[0] - counts['page_bytes'],
+             base[1] - s.phases().get('navigate', 0)) \
+        if base and s.attrs.get('pages') == 'lean' else None
+    return search_timing(s.name, s.attrs['airline'], s.secs, s.phases(),
+                         counts['retries'], counts['lookup_retries'],
+                         counts['timeouts'] + counts['lookup_timeouts'],
+                         slowest.get(s.name), counts['page_bytes'], saved)
+  return sorted((row(s) for s in root.walk() if 'airline' in s.attrs),
+                key=lambda r: -r.secs)
@@ -1,16 +1,8 @@
 #!/usr/bin/env python
 
-import csv, re, sys
+# Superseded by flightscraper.analytics; with no arguments this still turns an
+# mbox of emailed reports on stdin into (timestamp, cheapest price) CSV rows.
 
-ts = None
-nums = re.compile(r'\d\d\d')
-minx = float('inf')
-w = csv.writer(sys.stdout)
-for line in sys.stdin:
-  if line.startswith('From '):
-    if minx < float('inf'):
-      w.writerow((ts, minx))
-      minx = float('inf')
-    ts = line.split('  ',1)[1].strip()
-  else:
-    minx = min(minx, int(nums.search(line).group()))
+from flightscraper import analytics
+
+if __name__ == '__main__': analytics.main()
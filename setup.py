@@ -12,10 +12,20 @@ setup(
     selenium>=2.25.0
     parsedatetime>=0.8.7
     path.py>=2.4.1
-    ipdb>=0.7
+    lxml>=2.3
+    cssselect>=0.7
+    Jinja2>=2.6
     '''.split(),
+  extras_require = {
+    'analytics': ['numpy>=1.6', 'matplotlib>=1.1'],
+    'thumbnails': ['Pillow'],
+    'debug': ['ipdb>=0.7'],
+  },
   entry_points = {
-    'console_scripts': 'flightscraper = flightscraper:main'
+    'console_scripts': [
+      'flightscraper = flightscraper:main',
+      'flightscraper-store = flightscraper.store:main',
+    ]
   },
   # extra metadata for pypi
   author = 'Yang Zhang',